@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# dirty.py - time the dirty tree check on a large checkout
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python bench/dirty.py [--tracked N] [--untracked N] [--runs N]
+#
+# This makes a synthetic checkout with many tracked files, a big source
+# archive and an expanded build tree, the way a checkout looks after a
+# local build, and times GitPython's is_dirty against Commands.gitstate.
+# Each is timed with a warm index and again right after every tracked file
+# had its mtime changed, which forces git to look at file contents.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import git
+import pyrpkg
+
+
+def git_cmd(path, *args):
+    env = dict(os.environ)
+    for var in ['GIT_AUTHOR', 'GIT_COMMITTER']:
+        env.setdefault(var + '_NAME', 'bench')
+        env.setdefault(var + '_EMAIL', 'bench@example.com')
+    subprocess.check_call(['git'] + list(args), cwd=path, env=env,
+                          stdout=open(os.devnull, 'w'))
+
+
+def make_tree(path, tracked, untracked):
+    """Make a checkout at path with tracked and untracked files"""
+
+    git_cmd(path, 'init', '-q')
+    for i in range(tracked):
+        dirname = os.path.join(path, 'patches', str(i % 100))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        open(os.path.join(dirname, 'p%d.patch' % i), 'w').write(
+            'patch %d\n' % i * 20)
+    open(os.path.join(path, 'foo.spec'), 'w').write('Name: foo\n')
+    git_cmd(path, 'add', '.')
+    git_cmd(path, 'commit', '-q', '-m', 'import')
+    # The source archive and the tree rpmbuild expanded it into
+    archive = open(os.path.join(path, 'foo-1.0.tar.gz'), 'wb')
+    archive.write(os.urandom(64 * 1024 * 1024))
+    archive.close()
+    for i in range(untracked):
+        dirname = os.path.join(path, 'foo-1.0', 'src', str(i % 500))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        open(os.path.join(dirname, 'f%d.c' % i), 'w').write('int x;\n')
+
+
+def touch_tracked(path):
+    """Change the mtime of every tracked file"""
+
+    now = time.time() + 10
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path,
+                                                             'patches')):
+        for name in filenames:
+            os.utime(os.path.join(dirpath, name), (now, now))
+
+
+def time_call(func, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the dirty check')
+    parser.add_argument('--tracked', type=int, default=20000,
+                        help='Number of tracked files')
+    parser.add_argument('--untracked', type=int, default=100000,
+                        help='Number of files in the expanded build tree')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of times to run each check')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='rpkg-bench-')
+    try:
+        make_tree(path, args.tracked, args.untracked)
+
+        def commands():
+            return pyrpkg.Commands(path, None, None, None, None, None, None,
+                                   None, None, None)
+
+        checks = [('GitPython is_dirty(untracked_files=True)',
+                   lambda: git.Repo(path).is_dirty(untracked_files=True)),
+                  ('GitPython is_dirty()',
+                   lambda: git.Repo(path).is_dirty()),
+                  ('Commands.gitstate',
+                   lambda: commands().gitstate['dirty'])]
+        print('%d tracked, %d untracked files in %s' %
+              (args.tracked, args.untracked, path))
+        for name, check in checks:
+            git_cmd(path, 'update-index', '-q', '--refresh')
+            warm = time_call(check, args.runs)
+            touch_tracked(path)
+            cold = time_call(check, 1)
+            print('%-42s warm %8.1f ms   after touch %8.1f ms' %
+                  (name, warm, cold))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# startup.py - keep an eye on how long rpkg takes to get going
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python bench/startup.py [--runs N] [--max-ms MS]
+#
+# This times importing pyrpkg and setting up the cli parser in a fresh
+# interpreter, the way every rpkg run starts.  It fails if any of the heavy
+# modules got imported along the way, or if startup takes longer than
+# --max-ms.
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that only the commands needing them should import
+HEAVY = ['koji', 'rpm', 'git', 'pycurl', 'krbV', 'multiprocessing',
+         'xmlrpclib']
+
+SNIPPET = """
+import sys, time
+start = time.time()
+import pyrpkg
+import pyrpkg.cli
+client = pyrpkg.cli.cliClient(None, name='rpkg')
+elapsed = time.time() - start
+print('%%f %%s' %% (elapsed, ' '.join([m for m in %r if m in sys.modules])))
+""" % HEAVY
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time rpkg startup')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of interpreters to start')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if the median startup is slower than this')
+    args = parser.parse_args()
+
+    srcdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'src')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([srcdir] +
+                                        [p for p in [env.get('PYTHONPATH')]
+                                         if p])
+    times = []
+    loaded = set()
+    for i in range(args.runs):
+        output = subprocess.Popen([sys.executable, '-c', SNIPPET], env=env,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        fields = output.split()
+        times.append(float(fields[0]) * 1000)
+        loaded.update(fields[1:])
+    times.sort()
+    median = times[len(times) // 2]
+    print('startup: median %.1f ms, min %.1f ms, max %.1f ms over %d runs' %
+          (median, times[0], times[-1], len(times)))
+
+    failed = False
+    if loaded:
+        print('heavy modules imported at startup: %s' %
+              ' '.join(sorted(loaded)))
+        failed = True
+    if args.max_ms and median > args.max_ms:
+        print('startup is slower than %.1f ms' % args.max_ms)
+        failed = True
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
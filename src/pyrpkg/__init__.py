@@ -9,33 +9,42 @@
 # option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
 # the full text of the license.
 
+import copy
+import difflib
 import errno
 import os
+import time
 import sys
 import shutil
 import re
-import pycurl
+import random
+import string
 if sys.version_info[0:2] >= (2, 5):
     import subprocess
 else:
     # We need a subprocess that has check_call
     from kitchen.pycompat27 import subprocess
 import hashlib
-import koji
-import rpm
+import base64
+import json
 import logging
-import git
 import ConfigParser
 import stat
 import StringIO
 import tempfile
 import fnmatch
+import glob
+import threading
 import cli
-# Try to import krb, it's OK if it fails
-try:
-    import krbV
-except ImportError:
-    pass
+from utils import AtomicFile, LazyModule, run_parallel, write_atomic
+
+# These are slow to import and not every command needs them, so they are
+# only imported when first used.  Keep them out of the imports above.
+git = LazyModule('git')
+koji = LazyModule('koji')
+multiprocessing = LazyModule('multiprocessing')
+pycurl = LazyModule('pycurl')
+rpm = LazyModule('rpm')
 
 
 # Define our own error class
@@ -63,7 +72,7 @@ class Commands(object):
     def __init__(self, path, lookaside, lookasidehash, lookaside_cgi,
                  gitbaseurl, anongiturl, branchre, remote, kojiconfig,
                  build_client, user=None, dist=None, target=None,
-                 quiet=False):
+                 quiet=False, mirrordir=None):
         """Init the object and some configuration details."""
 
         # Path to operate on, most often pwd
@@ -78,6 +87,8 @@ class Commands(object):
         self.gitbaseurl = gitbaseurl
         # The anonymous version of the git url
         self.anongiturl = anongiturl
+        # A directory of local mirrors of anongiturl repos, if any
+        self.mirrordir = mirrordir
         # The regex of branches we care about
         self.branchre = branchre
         # The local name of the remote (usually 'origin')
@@ -92,11 +103,20 @@ class Commands(object):
         self.hashtype = 'sha256'
         # Set an attribute for quiet or not
         self.quiet = quiet
+        # Whether the metadata files we write (sources, .gitignore, clog,
+        # patches) are synced to disk.  Scripts doing lots of them in a
+        # batch they can redo may turn this off.
+        self.fsync = True
+        # How many seconds an updated mirror is used before it is fetched
+        # again, for long lived objects
+        self.mirror_ttl = 300
         # Set place holders for properties
         # Anonymous buildsys session
         self._anon_kojisession = None
         # The upstream branch a downstream branch is tracking
         self._branch_merge = None
+        # The directory to keep persistent caches in
+        self._cachedir = None
         # The latest commit
         self._commit = None
         # The disttag rpm value
@@ -107,6 +127,12 @@ class Commands(object):
         self._distvar = None
         # The rpm epoch of the cloned module
         self._epoch = None
+        # When we last updated the mirror of each module
+        self._fetched_mirrors = {}
+        # The sha256 digests uploads are recorded by, by file and its state
+        self._upload_digests = {}
+        # The branch, upstream, HEAD and dirty state of the repo
+        self._gitstate = None
         # An authenticated buildsys session
         self._kojisession = None
         # A web url of the buildsys server
@@ -121,6 +147,8 @@ class Commands(object):
         self._nvr = None
         # The rpm release of the cloned module
         self._rel = None
+        # The local and remote branches of the repo
+        self._refindex = None
         # The cloned repo object
         self._repo = None
         # The rpm defines used when calling rpm
@@ -251,20 +279,33 @@ class Commands(object):
         if self.dist:
             self._branch_merge = self.dist
         else:
-            try:
-                localbranch = self.repo.active_branch.name
-            except TypeError, e:
-                raise rpkgError('Repo in inconsistent state: %s' % e)
-            try:
-                merge = self.repo.git.config('--get',
-                                             'branch.%s.merge' % localbranch)
-            except git.GitCommandError, e:
+            if not self.gitstate['branch']:
+                raise rpkgError('Repo in inconsistent state: HEAD is not on '
+                                'a branch')
+            merge = self.gitstate['merge']
+            if not merge:
                 raise rpkgError('Unable to find remote branch.  Use --dist')
             # Trim off the refs/heads so that we're just working with
             # the branch name
             merge = merge.replace('refs/heads/', '')
             self._branch_merge = merge
 
+    @property
+    def cachedir(self):
+        """This property ensures the cachedir attribute"""
+
+        if not self._cachedir:
+            self.load_cachedir()
+        return self._cachedir
+
+    def load_cachedir(self):
+        """Find the directory to keep persistent caches in"""
+
+        # Sites that want their own cache would override this
+        cachehome = os.environ.get('XDG_CACHE_HOME',
+                                   os.path.expanduser('~/.cache'))
+        self._cachedir = os.path.join(cachehome, 'rpkg')
+
     @property
     def commithash(self):
         """This property ensures the commit attribute"""
@@ -277,12 +318,9 @@ class Commands(object):
         """Discover the latest commit to the package"""
 
         # Get the commit hash
-        comobj = self.repo.iter_commits().next()
-        # Work around different versions of GitPython
-        if hasattr(comobj, 'sha'):
-            self._commit = comobj.sha
-        else:
-            self._commit = comobj.hexsha
+        if not self.gitstate['head']:
+            raise rpkgError('There are no commits in %s' % self.path)
+        self._commit = self.gitstate['head']
 
     @property
     def disttag(self):
@@ -316,6 +354,85 @@ class Commands(object):
             self.load_nameverrel()
         return self._epoch
 
+    @property
+    def gitstate(self):
+        """This property ensures the gitstate attribute"""
+
+        if not self._gitstate:
+            self.load_gitstate()
+        return self._gitstate
+
+    def load_gitstate(self):
+        """Ask git about the branch, upstream, HEAD and dirty state at once
+
+        Rather than a git call for each of them, this takes one status and
+        one config call and keeps the results for the life of the object.
+        The dirty check only looks at tracked files, so untracked sources
+        and build trees are never scanned, and no rename detection is done.
+        git compares file stats against its index, refreshing the index
+        when it can so the next check is cheap, and uses an fsmonitor hook
+        if core.fsmonitor is set for the repo.  gitstate is a dict of:
+
+        head: the commit HEAD points at, None before the first commit
+        branch: the local branch, None when HEAD is detached
+        remote, merge: the branch.<branch>.remote and .merge config, if set
+        ahead, behind: how many commits HEAD is ahead of and behind its
+                       upstream, None without one
+        dirty: True if tracked files have staged or unstaged changes
+
+        This needs git 2.18 or newer for the status options used.
+        """
+
+        state = {'head': None, 'branch': None, 'remote': None, 'merge': None,
+                 'ahead': None, 'behind': None, 'dirty': False}
+        try:
+            status = self.repo.git.status('--porcelain=v2', '--branch',
+                                          '--untracked-files=no',
+                                          '--ignore-submodules',
+                                          '--no-renames')
+        except git.GitCommandError, e:
+            raise rpkgError('Could not get the state of %s: %s' %
+                            (self.path, e))
+        for line in status.splitlines():
+            if not line.startswith('# '):
+                # Any other line is a changed tracked file
+                state['dirty'] = True
+                continue
+            fields = line.split()
+            if fields[1] == 'branch.oid' and fields[2] != '(initial)':
+                state['head'] = fields[2]
+            elif fields[1] == 'branch.head' and fields[2] != '(detached)':
+                state['branch'] = fields[2]
+            elif fields[1] == 'branch.ab':
+                state['ahead'] = int(fields[2].lstrip('+'))
+                state['behind'] = int(fields[3].lstrip('-'))
+        if state['branch']:
+            prefix = 'branch.%s.' % state['branch']
+            try:
+                config = self.repo.git.config('-z', '--get-regexp',
+                                              r'^branch\.')
+            except git.GitCommandError:
+                # Nothing matched
+                config = ''
+            for entry in config.split('\0'):
+                key, sep, value = entry.partition('\n')
+                if key.startswith(prefix) and \
+                key[len(prefix):] in ('remote', 'merge'):
+                    state[key[len(prefix):]] = value
+        self._gitstate = state
+
+    def _forget_gitstate(self):
+        """Drop what we know about HEAD, the branches and the tree
+
+        Called after running git commands that change them, so long lived
+        objects ask git again.
+        """
+
+        self._gitstate = None
+        self._refindex = None
+        self._commit = None
+        self._branch_merge = None
+
     @property
     def kojisession(self):
         """This property ensures the kojisession attribute"""
@@ -425,6 +542,56 @@ class Commands(object):
         if self._epoch ==  "(none)":
             self._epoch = "0"
 
+    @property
+    def refindex(self):
+        """This property ensures the refindex attribute"""
+
+        if not self._refindex:
+            self.load_refindex()
+        return self._refindex
+
+    def load_refindex(self):
+        """Index the local and remote branches of the repo
+
+        One for-each-ref call lists the branches, tags and other refs are
+        not looked at.  refindex is a dict of:
+
+        locals: local branch names in git's order
+        remotes: remote branch names like origin/f16 in git's order
+        heads: a set of the local branch names
+        tracking: the remote branch to track for each branch name, from
+                  our remote if it has one, or the first remote that does
+        """
+
+        try:
+            output = self.repo.git.for_each_ref('--format=%(refname)',
+                                                'refs/heads', 'refs/remotes')
+        except git.GitCommandError, e:
+            raise rpkgError('Could not list the branches of %s: %s' %
+                            (self.path, e))
+        index = {'locals': [], 'remotes': [], 'heads': set(), 'tracking': {}}
+        prefix = '%s/' % self.remote
+        for ref in output.splitlines():
+            if ref.startswith('refs/heads/'):
+                name = ref[len('refs/heads/'):]
+                index['locals'].append(name)
+                index['heads'].add(name)
+                continue
+            name = ref[len('refs/remotes/'):]
+            if name.startswith(prefix):
+                branch = name[len(prefix):]
+            else:
+                branch = name.split('/', 1)[-1]
+            if branch == 'HEAD':
+                # Not useful in this context
+                continue
+            index['remotes'].append(name)
+            if name.startswith(prefix) or branch not in index['tracking']:
+                index['tracking'][branch] = name
+        self.log.debug('Found %d local and %d remote branches' %
+                       (len(index['locals']), len(index['remotes'])))
+        self._refindex = index
+
     @property
     def repo(self):
         """This property ensures the repo attribute"""
@@ -563,7 +730,10 @@ class Commands(object):
 
     def _has_krb_creds(self):
         # This function is lifted from /usr/bin/koji
-        if not sys.modules.has_key('krbV'):
+        # Try to import krb, it's OK if it fails
+        try:
+            import krbV
+        except ImportError:
             return False
         try:
             ctx = krbV.default_context()
@@ -748,6 +918,40 @@ class Commands(object):
             raise rpkgError('No compatible build arches found in %s' % spec)
         return archlist
 
+    def _spec_patches(self):
+        """Return a set of the patch file names the spec lists
+
+        The spec is parsed by rpm, with our rpm defines when we can tell
+        them, so the names have their macros expanded.
+        """
+
+        spec = os.path.join(self.path, self.spec)
+        macros = []
+        try:
+            defines = self.rpmdefines
+        except rpkgError, e:
+            self.log.debug('Parsing the spec without our defines: %s' % e)
+            defines = []
+        for define in defines:
+            # They look like --define 'name value'
+            try:
+                name, value = define.split("'")[1].split(None, 1)
+            except (IndexError, ValueError):
+                continue
+            rpm.addMacro(name, value)
+            macros.append(name)
+        try:
+            try:
+                hdr = rpm.spec(spec)
+            except Exception, er:
+                raise rpkgError('%s is not a spec file' % spec)
+        finally:
+            for name in macros:
+                rpm.delMacro(name)
+        ispatch = getattr(rpm, 'RPMBUILD_ISPATCH', 2)
+        return set([os.path.basename(name)
+                    for name, num, flags in hdr.sources if flags & ispatch])
+
     def _get_build_arches_from_srpm(self, srpm, arches):
         """Given the path to an srpm, determine the possible build arches
 
@@ -800,32 +1004,106 @@ class Commands(object):
     def _list_branches(self):
         """Returns a tuple of local and remote branch names"""
 
-        self.log.debug('Listing refs')
-        refs = self.repo.refs
-        # Sort into local and remote branches
-        remotes = []
-        locals = []
-        for ref in refs:
-            if type(ref) == git.Head:
-                self.log.debug('Found local branch %s' % ref.name)
-                locals.append(ref.name)
-            elif type(ref) == git.RemoteReference:
-                if ref.remote_head == 'HEAD':
-                    self.log.debug('Skipping remote branch alias HEAD')
-                    continue # Not useful in this context
-                self.log.debug('Found remote branch %s' % ref.name)
-                remotes.append(ref.name)
-        return (locals, remotes)
+        return (self.refindex['locals'], self.refindex['remotes'])
 
-    def _srpmdetails(self, srpm):
-        """Return a tuple of package name, package files, and upload files."""
+    def _checkout_cmd(self, path):
+        """Return a copy of this object working on the checkout at path
 
-        # This shouldn't change... often
-        UPLOADEXTS = ['tar', 'gz', 'bz2', 'lzma', 'xz', 'Z', 'zip', 'tff',
-                      'bin', 'tbz', 'tbz2', 'tgz', 'tlz', 'txz', 'pdf', 'rpm',
-                      'jar', 'war', 'db', 'cpio', 'jisp', 'egg', 'gem', 'spkg']
+        Everything learned about our own checkout is forgotten, as are the
+        build system sessions, which can't be shared with another process.
+        """
+
+        cmd = copy.copy(self)
+        # Options given to us rather than found out
+        keep = ('_cachedir', '_localarch', '_target', '_user')
+        for attr in cmd.__dict__.keys():
+            if attr.startswith('_') and attr not in keep:
+                setattr(cmd, attr, None)
+        cmd._fetched_mirrors = {}
+        cmd._upload_digests = {}
+        cmd.path = os.path.abspath(path)
+        return cmd
+
+    def _run_parallel(self, func, items, jobs=None):
+        """Call func on each of items using up to jobs worker threads
+
+        See utils.run_parallel
+        """
+
+        return run_parallel(func, items, jobs, self.log)
+
+    def _mirror(self, module):
+        """Return the path to an up to date local mirror of a module
+
+        The mirror is a bare git clone --mirror of the anongiturl repo kept
+        in mirrordir.  It is created the first time and updated with an
+        incremental fetch after that, at most once every mirror_ttl seconds
+        per Commands object.  Threads wanting the same mirror take turns.
+
+        Returns None if mirrors are not configured or could not be updated,
+        in which case callers should go to the remote instead.
+        """
+
+        if not self.mirrordir:
+            return None
+        url = self.anongiturl % {'module': module}
+        mirror = os.path.join(os.path.expanduser(self.mirrordir),
+                              '%s.git' % module)
+        _mirror_locks_lock.acquire()
+        try:
+            lock = _mirror_locks.setdefault(mirror, threading.Lock())
+        finally:
+            _mirror_locks_lock.release()
+        lock.acquire()
+        try:
+            if self._fetched_mirrors.get(module, 0) > \
+            time.time() - self.mirror_ttl:
+                return mirror
+            if os.path.isdir(mirror):
+                self.log.debug('Updating mirror %s' % mirror)
+                cmd = ['git', '--git-dir', mirror, 'fetch', '-q', '--prune']
+            else:
+                self.log.debug('Creating mirror %s of %s' % (mirror, url))
+                try:
+                    os.makedirs(os.path.dirname(mirror))
+                except OSError, e:
+                    # Another process may have just made it
+                    if e.errno != errno.EEXIST:
+                        self.log.warn('Could not create mirror of %s, using '
+                                      '%s: %s' % (module, url, e))
+                        return None
+                # Clone next to the mirror and move it in place when it's
+                # done, so nobody sees a partial mirror
+                tmpmirror = tempfile.mkdtemp(prefix='.%s.' % module,
+                                             dir=os.path.dirname(mirror))
+                cmd = ['git', 'clone', '-q', '--mirror', url, tmpmirror]
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                output, error = proc.communicate()
+            except OSError, e:
+                error = e
+                proc = None
+            if proc is None or proc.returncode:
+                self.log.warn('Could not update mirror of %s, using %s: %s' %
+                              (module, url, error))
+                if not os.path.isdir(mirror):
+                    shutil.rmtree(tmpmirror, ignore_errors=True)
+                return None
+            if not os.path.isdir(mirror):
+                try:
+                    os.rename(tmpmirror, mirror)
+                except OSError:
+                    # Another process won the race, theirs is as good as ours
+                    shutil.rmtree(tmpmirror, ignore_errors=True)
+            self._fetched_mirrors[module] = time.time()
+            return mirror
+        finally:
+            lock.release()
+
+    def _srpm_name(self, srpm):
+        """Return the package name of an srpm"""
 
-        # get the name
         cmd = ['rpm', '-qp', '--nosignature', '--qf', '%{NAME}', srpm]
                 # Run the command
         self.log.debug('Running: %s' % ' '.join(cmd))
@@ -835,9 +1113,20 @@ class Commands(object):
             output, error = proc.communicate()
         except OSError, e:
             raise rpkgError(e)
-        name = output
         if error:
             raise rpkgError('Error querying srpm: %s' % error)
+        return output
+
+    def _srpmdetails(self, srpm):
+        """Return a tuple of package name, package files, and upload files."""
+
+        # This shouldn't change... often
+        UPLOADEXTS = ['tar', 'gz', 'bz2', 'lzma', 'xz', 'Z', 'zip', 'tff',
+                      'bin', 'tbz', 'tbz2', 'tgz', 'tlz', 'txz', 'pdf', 'rpm',
+                      'jar', 'war', 'db', 'cpio', 'jisp', 'egg', 'gem', 'spkg']
+
+        # get the name
+        name = self._srpm_name(srpm)
 
         # now get the files and upload files
         files = []
@@ -863,6 +1152,119 @@ class Commands(object):
 
         return((name, files, uploadfiles))
 
+    def _srpm_digests(self, srpm):
+        """Return the hash type and a dict of file digests of an srpm
+
+        The digests come from the srpm header, so nothing is extracted.
+        """
+
+        # rpm's numbers for its digest algorithms
+        algos = {'1': 'md5', '2': 'sha1', '8': 'sha256', '9': 'sha384',
+                 '10': 'sha512', '11': 'sha224', '(none)': 'md5'}
+        cmd = ['rpm', '-qp', '--nosignature', '--qf',
+               '%{FILEDIGESTALGO}\n[%{FILENAMES}\t%{FILEDIGESTS}\n]', srpm]
+        self.log.debug('Running: %s' % ' '.join(cmd))
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, error = proc.communicate()
+        except OSError, e:
+            raise rpkgError(e)
+        if error or proc.returncode:
+            raise rpkgError('Error querying srpm: %s' % error)
+        lines = output.splitlines()
+        if not lines or lines[0] not in algos:
+            raise rpkgError('Unknown digest algorithm in %s' % srpm)
+        digests = {}
+        for line in lines[1:]:
+            file, sep, digest = line.rpartition('\t')
+            digests[file] = digest
+        return (algos[lines[0]], digests)
+
+    def _srpm_extract(self, srpm, files, destdir=None):
+        """Extract files from the payload of an srpm into destdir
+
+        destdir defaults to the current directory.  The payload is streamed
+        through cpio, which only writes out the files asked for, so a single
+        file can be had without unpacking the archives next to it.
+        """
+
+        if not files:
+            return
+        cmd = ['rpm2cpio', srpm]
+        # We have to force cpio to copy out (u) because git messes with
+        # timestamps.  Names are matched as globs, so escape those.
+        cmd2 = ['cpio', '-iud', '--quiet'] + \
+               [re.sub(r'([][*?\\])', r'\\\1', file) for file in files]
+        self.log.debug('Running: %s | %s' % (' '.join(cmd),
+                                             ' '.join(cmd2)))
+        try:
+            rpmcall = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            cpiocall = subprocess.Popen(cmd2, stdin=rpmcall.stdout,
+                                        stderr=subprocess.PIPE,
+                                        cwd=destdir)
+            rpmcall.stdout.close()
+            output, err = cpiocall.communicate()
+            rpmcall.wait()
+        except OSError, e:
+            raise rpkgError(e)
+        if err or cpiocall.returncode or rpmcall.returncode:
+            raise rpkgError("Got an error from rpm2cpio: %s" % err)
+
+    def _srpm_fingerprint(self, hashtype):
+        """Return a digest of everything that goes into our srpm
+
+        This covers the spec and every tracked file, the archives listed in
+        the sources file, the rpm defines and the hashtype.  Tracked files
+        are covered by the tree of HEAD, with only the files git status
+        reports as changed and the spec hashed.  Archives are tracked by
+        the digest in the sources file plus their size and mtime on disk,
+        rather than hashed again.
+
+        Returns None if no fingerprint can be made, such as outside a repo.
+        """
+
+        sum = hashlib.sha256()
+        sum.update('%s\0' % '\0'.join(self.rpmdefines + [hashtype]))
+        try:
+            tree = self.repo.git.rev_parse('HEAD^{tree}')
+            status = self.repo.git.status('--porcelain', '-z',
+                                          '--untracked-files=no',
+                                          '--ignore-submodules',
+                                          '--no-renames')
+        except (rpkgError, git.GitCommandError), e:
+            self.log.debug('Not fingerprinting the srpm: %s' % e)
+            return None
+        sum.update('%s\0' % tree)
+        # Entries are the two status letters, a space and the path
+        changed = set([entry[3:] for entry in status.split('\0') if entry])
+        changed.add(self.spec)
+        for file in sorted(changed):
+            path = os.path.join(self.path, file)
+            if os.path.isfile(path):
+                sum.update('%s\0%s\0' % (file,
+                                          self._hash_file(path, 'sha256')))
+            else:
+                # Deleted since HEAD
+                sum.update('%s\0\0' % file)
+        sources = SourcesFile(os.path.join(self.path, 'sources'),
+                              self.lookasidehash)
+        for file, csumtype, csum in sources:
+            try:
+                info = os.stat(os.path.join(self.path, file))
+            except OSError:
+                # Missing archive, rpmbuild will complain in a bit
+                return None
+            sum.update('%s\0%s\0%s\0%s\0' % (file, csum, info.st_size,
+                                              info.st_mtime))
+        return sum.hexdigest()
+
+    def _srpm_stamp(self, srpm):
+        """Return the path recording the fingerprint an srpm was built from"""
+
+        name = hashlib.sha1(os.path.abspath(srpm)).hexdigest()
+        return os.path.join(self.cachedir, 'srpm', name)
+
     def add_tag(self, tagname, force=False, message=None, file=None):
         """Add a git tag to the repository
 
@@ -913,26 +1315,15 @@ class Commands(object):
         self._run_command(cmd, cwd=self.path)
         return
 
-    def clone(self, module, path=None, branch=None, bare_dir=None, anon=False):
-        """Clone a repo, optionally check out a specific branch.
-
-        module is the name of the module to clone
-
-        path is the basedir to perform the clone in
-
-        branch is the name of a branch to checkout instead of <remote>/master
-
-        bare_dir is the name of a directory to make a bare clone to, if this is a
-        bare clone. None otherwise.
-
-        anon is whether or not to clone anonymously
+    def _clone_command(self, module, branch=None, bare_dir=None, anon=False,
+                       depth=None, reference=None):
+        """Build the git clone command for a module
 
-        Logs the output and returns nothing.
+        See clone for the arguments.
 
+        Returns the command as a list
         """
 
-        if not path:
-            path = self.path
         # construct the git url
         if anon:
             giturl = self.anongiturl % {'module': module}
@@ -943,6 +1334,23 @@ class Commands(object):
         cmd = ['git', 'clone']
         if self.quiet:
             cmd.append('-q')
+        if depth:
+            cmd.extend(['--depth', str(depth)])
+        if not reference and not depth and self.mirrordir:
+            # Get the objects from our mirror rather than the git server, but
+            # don't depend on the mirror staying around afterwards
+            mirror = self._mirror(module)
+            if mirror:
+                self.log.debug('Using mirror %s as reference' % mirror)
+                cmd.extend(['--reference', mirror, '--dissociate'])
+        if reference:
+            # Borrow objects from a local copy if we have one for the module
+            for refpath in (os.path.join(reference, '%s.git' % module),
+                            os.path.join(reference, module)):
+                if os.path.isdir(refpath):
+                    self.log.debug('Using %s as reference' % refpath)
+                    cmd.extend(['--reference', refpath])
+                    break
         # do the clone
         if branch and bare_dir:
             raise rpkgError('Cannot combine bare cloning with a branch')
@@ -960,23 +1368,111 @@ class Commands(object):
         if not bare_dir:
             # --bare and --origin are incompatible
             cmd.extend(['--origin', self.remote])
+        return cmd
+
+    def clone(self, module, path=None, branch=None, bare_dir=None, anon=False,
+              depth=None, reference=None):
+        """Clone a repo, optionally check out a specific branch.
+
+        module is the name of the module to clone
+
+        path is the basedir to perform the clone in
+
+        branch is the name of a branch to checkout instead of <remote>/master
+
+        bare_dir is the name of a directory to make a bare clone to, if this is a
+        bare clone. None otherwise.
+
+        anon is whether or not to clone anonymously
+
+        depth makes a shallow clone with that many commits of history
+
+        reference is a directory of local repos named <module>.git or
+        <module> to borrow objects from, when one exists for module.
+        Without it, and unless depth is given, objects come from the
+        configured mirror of the module if there is one.
+
+        Logs the output and returns nothing.
+
+        """
 
+        if not path:
+            path = self.path
+        cmd = self._clone_command(module, branch, bare_dir, anon, depth,
+                                  reference)
         self._run_command(cmd, cwd=path)
 
         return
 
-    def clone_with_dirs(self, module, anon=False):
+    def clone_modules(self, modules, path=None, branch=None, anon=False,
+                      depth=None, reference=None, jobs=None):
+        """Clone several modules at once
+
+        modules is a list of module names, the other arguments are as for
+        clone.  At most jobs clones run at a time, defaulting to the number
+        of cpus.  The output of each clone is only logged when it fails.
+
+        Logs a report and returns a dict of module to the error cloning it,
+        or None if it was cloned.
+        """
+
+        if not path:
+            path = self.path
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        # Two workers must not clone into the same directory
+        seen = set()
+        modules = [module for module in modules
+                   if not (module in seen or seen.add(module))]
+        # Resolve the user now rather than from the worker threads
+        if not anon:
+            self.user
+
+        def clone_module(module):
+            cmd = self._clone_command(module, branch, anon=anon, depth=depth,
+                                      reference=reference)
+            self.log.debug('Running %s' % ' '.join(cmd))
+            try:
+                proc = subprocess.Popen(cmd, cwd=path, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+            except OSError, e:
+                raise rpkgError(e)
+            if proc.returncode:
+                raise rpkgError(output.strip())
+            self.log.info('Cloned %s' % module)
+
+        results = {}
+        for module, result, error in self._run_parallel(clone_module,
+                                                        modules, jobs):
+            results[module] = error
+        failed = [module for module in modules if results[module]]
+        self.log.info('Cloned %s of %s modules' % (len(modules) - len(failed),
+                                                   len(modules)))
+        for module in failed:
+            self.log.error('Could not clone %s: %s' % (module, results[module]))
+        return results
+
+    def clone_with_dirs(self, module, anon=False, shared=False, jobs=None,
+                        reference=None):
         """Clone a repo old style with subdirs for each branch.
 
         module is the name of the module to clone
 
-        gitargs is an option list of arguments to git clone
+        anon is whether or not to clone anonymously
+
+        shared keeps the bare clone around as rpkg.git and has the branch
+        subdirs borrow its objects instead of getting a copy each
+
+        jobs is the number of branch subdirs to clone at once, defaults to
+        the number of cpus
+
+        reference is as for clone, and used for the bare clone
 
         """
 
         # Get the full path of, and git object for, our directory of branches
         top_path = os.path.join(self.path, module)
-        top_git = git.Git(top_path)
         repo_path = os.path.join(top_path, 'rpkg.git')
 
         # construct the git url
@@ -994,7 +1490,8 @@ class Commands(object):
 
         # Create a bare clone first. This gives us a good list of branches
         try:
-            self.clone(module, top_path, bare_dir=repo_path, anon=anon)
+            self.clone(module, top_path, bare_dir=repo_path, anon=anon,
+                       reference=reference)
         except Exception, e:
             # Clean out our directory
             shutil.rmtree(top_path)
@@ -1006,11 +1503,14 @@ class Commands(object):
         branches = [x for x in repo_git.branch().split() if x != "*" and
                 re.search(self.branchre, x)]
 
-        for branch in branches:
+        def clone_branch(branch):
             try:
                 # Make a local clone for our branch
-                top_git.clone("--branch", branch, '--origin', self.remote,
-                        repo_path, branch)
+                args = ["--branch", branch, '--origin', self.remote]
+                if shared:
+                    # Use the bare repo as an alternate object store
+                    args.append('--shared')
+                git.Git(top_path).clone(*(args + [repo_path, branch]))
 
                 # Set the remote correctly
                 branch_path = os.path.join(top_path, branch)
@@ -1021,8 +1521,20 @@ class Commands(object):
                 raise rpkgError('Could not locally clone %s from %s: %s' %
                         (branch, repo_path, e))
 
-        # We don't need this now. Ignore errors since keeping it does no harm
-        shutil.rmtree(repo_path, ignore_errors=True)
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        results = self._run_parallel(clone_branch, branches, jobs)
+        errors = [error for branch, result, error in results if error]
+        if errors:
+            raise rpkgError('\n'.join([str(error) for error in errors]))
+
+        if shared:
+            self.log.info('Branch directories share objects with %s, do not '
+                          'remove it' % repo_path)
+        else:
+            # We don't need this now. Ignore errors since keeping it does no
+            # harm
+            shutil.rmtree(repo_path, ignore_errors=True)
 
     def commit(self, message=None, file=None, files=[]):
         """Commit changes to a module (optionally found at path)
@@ -1063,7 +1575,10 @@ class Commands(object):
         else:
             cmd.extend(files)
         # make it so
-        self._run_command(cmd, cwd=self.path)
+        try:
+            self._run_command(cmd, cwd=self.path)
+        finally:
+            self._forget_gitstate()
         return
 
     def delete_tag(self, tagname):
@@ -1085,9 +1600,6 @@ class Commands(object):
 
         """
 
-        # Things work better if we're in our module directory
-        oldpath = os.getcwd()
-        os.chdir(self.path)
         # build up the command
         cmd = ['git', 'diff']
         if cached:
@@ -1095,17 +1607,16 @@ class Commands(object):
         if files:
             cmd.extend(files)
 
-        # Run it!
-        self._run_command(cmd)
-        # popd
-        os.chdir(oldpath)
+        # Run it from our module directory, the files are relative to it
+        self._run_command(cmd, cwd=self.path)
         return
 
     def get_latest_commit(self, module, branch):
         """Discover the latest commit has for a given module and return it"""
 
         # This is stupid that I have to use subprocess :/
-        url = self.anongiturl % {'module': module}
+        # Ask our local mirror when we have one
+        url = self._mirror(module) or self.anongiturl % {'module': module}
         # This cmd below only works to scratch build rawhide
         # We need something better for epel
         cmd = ['git', 'ls-remote', url, 'refs/heads/%s' % branch]
@@ -1144,7 +1655,8 @@ class Commands(object):
             # snag everything after the last # mark
             cvstag = buildsource.rsplit('#')[-1]
             # Now read the remote repo to figure out the hash from the tag
-            giturl = self.anongiturl % {'module': bdata['name']}
+            giturl = self._mirror(bdata['name']) or \
+                     self.anongiturl % {'module': bdata['name']}
             cmd = ['git', 'ls-remote', '--tags', giturl, cvstag]
             self.log.debug('Querying git server for tag info')
             try:
@@ -1174,6 +1686,8 @@ class Commands(object):
 
         upload new files to the lookaside, and stage the changes.
 
+        Only the files that differ from the srpm are extracted and staged.
+
         Returns a list of files to upload.
 
         """
@@ -1183,7 +1697,7 @@ class Commands(object):
         if not os.path.exists(srpm):
             raise rpkgError('File not found.')
         # bail if we're dirty
-        if self.repo.is_dirty():
+        if self.gitstate['dirty']:
             raise rpkgError('There are uncommitted changes in your repo')
         # Get the details of the srpm
         name, files, uploadfiles = self._srpmdetails(srpm)
@@ -1193,53 +1707,170 @@ class Commands(object):
         # Get a list of files we're currently tracking
         ourfiles = self.repo.git.ls_files().split('\n')
         # Trim out sources and .gitignore
-        try:
-            ourfiles.remove('.gitignore')
-            ourfiles.remove('sources')
-        except ValueError:
-            pass
-        try:
-            ourfiles.remove('sources')
-        except ValueError:
-            pass
-
-        # Things work better if we're in our module directory
-        oldpath = os.getcwd()
-        os.chdir(self.path)
+        for file in ('.gitignore', 'sources'):
+            if file in ourfiles:
+                ourfiles.remove(file)
 
         # Look through our files and if it isn't in the new files, remove it.
-        for file in ourfiles:
-            if file not in files:
-                self.log.info("Removing no longer used file: %s" % file)
-                rv = self.repo.index.remove([file])
-                os.remove(file)
-
-        # Extract new files
-        cmd = ['rpm2cpio', srpm]
-        # We have to force cpio to copy out (u) because git messes with
-        # timestamps
-        cmd2 = ['cpio', '-iud', '--quiet']
-
-        rpmcall = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        cpiocall = subprocess.Popen(cmd2, stdin=rpmcall.stdout)
-        output, err = cpiocall.communicate()
-        if output:
-            self.log.debug(output)
-        if err:
-            os.chdir(oldpath)
-            raise rpkgError("Got an error from rpm2cpio: %s" % err)
-
-        # And finally add all the files we know about (and our stock files)
-        for file in ('.gitignore', 'sources'):
-            if not os.path.exists(file):
-                # Create the file
-                open(file, 'w').close()
-            files.append(file)
-        rv = self.repo.index.add(files)
+        # Paths are kept relative to our module directory for git, and
+        # joined to it for everything else, as batch runs several imports
+        # in one process.
+        removed = [file for file in ourfiles if file and file not in files]
+        for file in removed:
+            self.log.info("Removing no longer used file: %s" % file)
+        if removed:
+            self.repo.index.remove(removed)
+            for file in removed:
+                os.remove(os.path.join(self.path, file))
+
+        # Only extract what differs from the files we have.  The tree is
+        # clean, so the tracked files we have are what is in the index.
+        hashtype, digests = self._srpm_digests(srpm)
+        changed = []
+        for file in files + uploadfiles:
+            path = os.path.join(self.path, file)
+            if not os.path.exists(path) or not digests.get(file) or \
+            self._hash_file(path, hashtype) != digests[file]:
+                changed.append(file)
+        self.log.debug('%d of %d files changed' %
+                       (len(changed), len(files + uploadfiles)))
+        self._srpm_extract(srpm, changed, self.path)
+
+        # And finally stage what changed (and our stock files)
+        toadd = [file for file in files
+                 if file in changed or file not in ourfiles]
+        if not os.path.exists(os.path.join(self.path, '.gitignore')):
+            # Create the file
+            open(os.path.join(self.path, '.gitignore'), 'w').close()
+            toadd.append('.gitignore')
+        sources = SourcesFile(os.path.join(self.path, 'sources'),
+                              self.lookasidehash)
+        # Forget archives the srpm no longer has
+        for file, csumtype, csum in list(sources):
+            if file not in uploadfiles:
+                sources.remove(file)
+        if sources.modified or not os.path.exists(sources.path):
+            sources.write(force=True, fsync=self.fsync)
+            toadd.append('sources')
+        if toadd:
+            self.repo.index.add(toadd)
         # Return to the caller and let them take it from there.
-        os.chdir(oldpath)
         return(uploadfiles)
 
+    def import_srpms(self, srpms, topdir=None, jobs=None):
+        """Import many srpms into the checkouts of their modules
+
+        srpms: list of srpm files
+        topdir: directory with a checkout of each module, named after it,
+                defaults to our path
+        jobs: number of imports to run at once, defaults to the number of
+              cpus
+
+        The imports run in worker processes.  Their archives are then
+        hashed once each and the ones the lookaside lacks uploaded from
+        threads, after which each checkout gets its sources and .gitignore
+        updated and staged.  Nothing is committed.
+
+        Logs a report and returns a dict of srpm to error, None if the
+        import succeeded.
+        """
+
+        if not topdir:
+            topdir = self.path
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        results = {}
+        # srpm, module name and Commands object of each import
+        imports = []
+        seen = {}
+        for srpm, name, error in self._run_parallel(self._srpm_name, srpms,
+                                                    jobs):
+            checkout = name and os.path.join(topdir, name)
+            if error:
+                results[srpm] = error
+            elif not os.path.isdir(checkout):
+                results[srpm] = 'No checkout of %s at %s' % (name, checkout)
+            elif name in seen:
+                results[srpm] = '%s is imported from %s already' % \
+                                (name, seen[name])
+            else:
+                seen[name] = srpm
+                imports.append((srpm, name, self._checkout_cmd(checkout)))
+
+        # The workers are forked and pick their job from this list
+        global _import_jobs
+        _import_jobs = [(cmd, srpm) for srpm, name, cmd in imports]
+        outcomes = []
+        if imports:
+            pool = multiprocessing.Pool(min(jobs, len(imports)))
+            try:
+                # A timeout on get keeps a ^C from hanging the pool
+                outcomes = pool.map_async(_import_srpm_job,
+                                          range(len(imports))).get(9999999)
+            finally:
+                pool.terminate()
+                _import_jobs = []
+
+        # Hash each archive once, even if listed by several packages
+        uploads = []
+        hashes = {}
+        for (srpm, name, cmd), (files, error) in zip(imports, outcomes):
+            if error:
+                results[srpm] = error
+                continue
+            uploads.append((srpm, name, cmd, files))
+            for file in files:
+                hashes[file] = None
+        for file, hash, error in self._run_parallel(
+                lambda file: self._hash_file(file, self.lookasidehash),
+                hashes.keys(), jobs):
+            hashes[file] = hash
+
+        # Ask the lookaside about and upload what each module needs once
+        needed = {}
+        for srpm, name, cmd, files in uploads:
+            for file in files:
+                if hashes[file]:
+                    needed.setdefault((name, os.path.basename(file),
+                                       hashes[file]), file)
+
+        def send(key):
+            name, basename, hash = key
+            if self.file_exists(name, basename, hash):
+                self.log.debug('%s of %s already uploaded' % (basename, name))
+                return
+            self.log.info('Uploading: %s  %s' % (hash, needed[key]))
+            self.upload_file(name, needed[key], hash)
+
+        failed = {}
+        for key, result, error in self._run_parallel(send, needed.keys(),
+                                                     jobs):
+            if error:
+                failed[key[0]] = error
+
+        for srpm, name, cmd, files in uploads:
+            missing = [file for file in files if not hashes[file]]
+            if missing:
+                results[srpm] = 'Could not hash %s' % ', '.join(missing)
+            elif name in failed:
+                results[srpm] = failed[name]
+            else:
+                try:
+                    cmd._record_sources([(hashes[file],
+                                          os.path.basename(file))
+                                         for file in files], replace=True)
+                    results[srpm] = None
+                except Exception, e:
+                    results[srpm] = e
+
+        self.log.info('Import results:')
+        for srpm in srpms:
+            if results[srpm]:
+                self.log.info('  %s: FAILED (%s)' % (srpm, results[srpm]))
+            else:
+                self.log.info('  %s: imported' % srpm)
+        return results
+
     def list_tag(self, tagname=None):
         """Create a list of all tags in the repository which match a given tagname.
 
@@ -1254,87 +1885,194 @@ class Commands(object):
         # make it so
         self._run_command(cmd)
 
-    def new(self):
-        """Return changes in a repo since the last tag"""
+    def list_tags(self, tagname=None):
+        """Return the names of the tags in the repository matching tagname
+
+        Like list_tag, but for callers that want the list rather than git's
+        output.
+        """
+
+        args = ['-l']
+        if tagname and tagname != '*':
+            args.append(tagname)
+        return self.repo.git.tag(*args).splitlines()
+
+    def latest_tag(self):
+        """Return the name of the most recent tag reachable from HEAD"""
+
+        return self.repo.git.describe('--tags', '--abbrev=0')
+
+    def new(self, tag=None):
+        """Return changes in a repo since the last tag
+
+        tag can be given to diff from another tag.
+        """
 
         # Find the latest tag
-        tag = self.repo.git.describe('--tags', '--abbrev=0')
+        if not tag:
+            tag = self.latest_tag()
         # Now get the diff
         self.log.debug('Diffing from tag %s' % tag)
         return self.repo.git.diff('-M', tag)
 
-    def patch(self, suffix, rediff=False):
+    def _diff_time(self, path):
+        """Return the mtime of path the way diff shows it"""
+
+        mtime = os.stat(path).st_mtime
+        local = time.localtime(mtime)
+        if local.tm_isdst > 0:
+            offset = -time.altzone
+        else:
+            offset = -time.timezone
+        return '%s.%09d %s%02d%02d' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                                     local),
+                                       (mtime % 1) * 1e9,
+                                       offset < 0 and '-' or '+',
+                                       abs(offset) // 3600,
+                                       abs(offset) % 3600 // 60)
+
+    def _native_diff(self, srcdir, suffix, output):
+        """Write a gendiff style diff of srcdir to the output file
+
+        Only the files named with suffix are looked at.  Each is diffed
+        against the file without the suffix, one pair at a time, and the
+        unified diff written out as it is made.  Paths are relative to our
+        path, as gendiff would have them.
+
+        Returns the number of files that differ.
+        """
+
+        origs = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.path,
+                                                                 srcdir)):
+            origs.extend([os.path.join(dirpath, name) for name in filenames
+                          if name.endswith(suffix) and name != suffix])
+        changed = 0
+        for orig in sorted(origs):
+            new = orig[:-len(suffix)]
+            origname = os.path.relpath(orig, self.path)
+            newname = os.path.relpath(new, self.path)
+            old = open(orig, 'rb').read()
+            if os.path.exists(new):
+                cur = open(new, 'rb').read()
+                curtime = self._diff_time(new)
+            else:
+                cur = ''
+                curtime = '1970-01-01 00:00:00.000000000 +0000'
+            if old == cur:
+                continue
+            changed += 1
+            output.write('diff -up %s %s\n' % (origname, newname))
+            if '\0' in old or '\0' in cur:
+                output.write('Binary files %s and %s differ\n' %
+                             (origname, newname))
+                continue
+            for line in difflib.unified_diff(old.splitlines(True),
+                                             cur.splitlines(True),
+                                             origname, newname,
+                                             self._diff_time(orig), curtime):
+                output.write(line)
+                if not line.endswith('\n'):
+                    output.write('\n\\ No newline at end of file\n')
+        return changed
+
+    def patch(self, suffix, rediff=False, native=False):
         """Generate a patch from the expanded source and add it to index
 
         suffix: Look for files named with this suffix to diff
         rediff: optionally retain any comments in the patch file and rediff
+        native: diff in process rather than with gendiff
 
         Will create a patch file named name-version-suffix.patch
         """
 
         # Create the outfile name based on arguments
         outfile = '%s-%s-%s.patch' % (self.module_name, self.ver, suffix)
+        patchpath = os.path.join(self.path, outfile)
 
         # If we want to rediff, the patch file has to already exist
-        if rediff and not os.path.exists(os.path.join(self.path, outfile)):
+        if rediff and not os.path.exists(patchpath):
             raise rpkgError('Patch file %s not found, unable to rediff' %
-                            os.path.join(self.path, outfile))
+                            patchpath)
 
         # See if there is a source dir to diff in
-        if not os.path.isdir(os.path.join(self.path,
-                                          '%s-%s' % (self.module_name,
-                                                     self.ver))):
+        srcdir = '%s-%s' % (self.module_name, self.ver)
+        if not os.path.isdir(os.path.join(self.path, srcdir)):
             raise rpkgError('Expanded source dir not found!')
 
+        # The patch is written as it is made and only replaces the old one
+        # once it is complete
+        output = AtomicFile(patchpath, self.fsync)
+        try:
+            # See if we are rediffing and keep the lines preceding the diff
+            if rediff:
+                oldpatch = open(patchpath, 'r')
+                for line in oldpatch:
+                    if line.startswith('diff'):
+                        break
+                    output.write(line)
+                oldpatch.close()
+                log.debug('Saved the header of the previous patch')
+
+            if native:
+                if not self._native_diff(srcdir, '.%s' % suffix, output):
+                    raise rpkgError('No changes found to make a patch of!')
+            else:
+                self._gendiff(srcdir, '.%s' % suffix, output)
+
+            if rediff:
+                # back up the old file
+                self.log.debug('Backing up existing patch %s to %s~' %
+                               (outfile, outfile))
+                if os.path.exists('%s~' % patchpath):
+                    os.remove('%s~' % patchpath)
+                try:
+                    os.link(patchpath, '%s~' % patchpath)
+                except OSError:
+                    shutil.copy2(patchpath, '%s~' % patchpath)
+        except:
+            output.abort()
+            raise
+        output.close()
+
+        # Add it to the index
+        # Again this returns a blank line we want to keep quiet
+        rv = self.repo.index.add([outfile])
+        log.info('Created %s and added it to the index' % outfile)
+
+    def _gendiff(self, srcdir, suffix, output):
+        """Run gendiff on srcdir, copying its diff to the output file"""
+
         # Setup the command
-        cmd = ['gendiff', '%s-%s' % (self.module_name, self.ver),
-               '.%s' % suffix]
+        cmd = ['gendiff', srcdir, suffix]
 
-        # Try to run the command and capture the output
+        # Try to run the command and stream the output
+        errors = tempfile.TemporaryFile()
+        written = 0
         try:
             self.log.debug('Running %s' % ' '.join(cmd))
-            (output, errors) = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE,
-                                                cwd=self.path).communicate()
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=errors, cwd=self.path)
+            while True:
+                chunk = proc.stdout.read(65536)
+                if not chunk:
+                    break
+                output.write(chunk)
+                written += len(chunk)
+            proc.wait()
         except Exception, e:
             raise rpkgError('Error running gendiff: %s' % e)
 
         # log any errors
+        errors.seek(0)
+        errors = errors.read()
         if errors:
             self.log.error(errors)
 
         # See if we got anything
-        if not output:
+        if not written:
             raise rpkgError('gendiff generated an empty patch!')
 
-        # See if we are rediffing and handle the old patch file
-        if rediff:
-            oldpatch = open(os.path.join(self.path, outfile), 'r').readlines()
-            # back up the old file
-            self.log.debug('Moving existing patch %s to %s~' % (outfile,
-                                                                outfile))
-            os.rename(os.path.join(self.path, outfile),
-                      '%s~' % os.path.join(self.path, outfile))
-            # Capture the lines preceding the diff
-            newhead = []
-            for line in oldpatch:
-                if line.startswith('diff'):
-                    break
-                else:
-                    newhead.append(line)
-
-            log.debug('Saved from previous patch: \n%s' % ''.join(newhead))
-            # Stuff the new head in front of the existing output
-            output = ''.join(newhead) + output
-
-        # Write out the patch
-        open(os.path.join(self.path, outfile), 'w').write(output)
-
-        # Add it to the index
-        # Again this returns a blank line we want to keep quiet
-        rv = self.repo.index.add([outfile])
-        log.info('Created %s and added it to the index' % outfile)
-
     def pull(self, rebase=False, norebase=False):
         """Pull changes from the remote repository
 
@@ -1351,7 +2089,10 @@ class Commands(object):
             cmd.append('--rebase')
         if norebase:
             cmd.append('--no-rebase')
-        self._run_command(cmd, cwd=self.path)
+        try:
+            self._run_command(cmd, cwd=self.path)
+        finally:
+            self._forget_gitstate()
         return
 
     def push(self):
@@ -1365,32 +2106,29 @@ class Commands(object):
         cmd = ['git', 'push']
         if self.quiet:
             cmd.append('-q')
-        self._run_command(cmd, cwd=self.path)
+        try:
+            self._run_command(cmd, cwd=self.path)
+        finally:
+            # Pushing moves the remote branch we are ahead of
+            self._forget_gitstate()
         return
 
     def sources(self, outdir=None):
         """Download source files"""
 
-        try:
-            archives = open(os.path.join(self.path, 'sources'),
-                            'r').readlines()
-        except IOError, e:
-            raise rpkgError('%s is not a valid repo: %s' % (self.path, e))
+        sources = os.path.join(self.path, 'sources')
+        if not os.path.exists(sources):
+            raise rpkgError('%s is not a valid repo: no sources file' %
+                            self.path)
+        archives = SourcesFile(sources, self.lookasidehash)
         # Default to putting the files where the module is
         if not outdir:
             outdir = self.path
-        for archive in archives:
-            try:
-                # This strip / split is kind a ugly, but checksums shouldn't have
-                # two spaces in them.  sources file might need more structure in the
-                # future
-                csum, file = archive.strip().split('  ', 1)
-            except ValueError:
-                raise rpkgError('Malformed sources file.')
+        for file, csumtype, csum in archives:
             # See if we already have a valid copy downloaded
             outfile = os.path.join(outdir, file)
             if os.path.exists(outfile):
-                if self._verify_file(outfile, csum, self.lookasidehash):
+                if self._verify_file(outfile, csum, csumtype):
                     continue
             self.log.info("Downloading %s" % (file))
             url = '%s/%s/%s/%s/%s' % (self.lookaside, self.module_name,
@@ -1422,7 +2160,7 @@ class Commands(object):
                 command.append('-s')
             command.append(url)
             self._run_command(command)
-            if not self._verify_file(outfile, csum, self.lookasidehash):
+            if not self._verify_file(outfile, csum, csumtype):
                 raise rpkgError('%s failed checksum' % file)
         return
 
@@ -1435,27 +2173,19 @@ class Commands(object):
         Logs output and returns nothing.
         """
 
-        # Currently this just grabs the first matching branch name from
-        # the first remote it finds.  When multiple remotes are in play
-        # this needs to get smarter
+        # The branch of our remote is tracked if there is one, otherwise
+        # that of the first remote that has it.
 
         # See if the repo is dirty first
-        if self.repo.is_dirty():
+        if self.gitstate['dirty']:
             raise rpkgError('%s has uncommitted changes.  Use git status '
                             'to see details' % self.path)
 
-        # Get our list of branches
-        (locals, remotes) = self._list_branches()
-
-        if not branch in locals:
+        if not branch in self.refindex['heads']:
             # We need to create a branch
             self.log.debug('No local branch found, creating a new one')
-            totrack = None
-            for remote in remotes:
-                if remote.endswith(branch):
-                    totrack = remote
-                    break
-            else:
+            totrack = self.refindex['tracking'].get(branch)
+            if not totrack:
                 raise rpkgError('Unknown remote branch %s' % branch)
             try:
                 self.log.info(self.repo.git.checkout('-b', branch, '--track',
@@ -1469,6 +2199,8 @@ class Commands(object):
                 self.log.info("Switched to branch '%s'" % branch)
             except: # This needs to be finer grained I think...
                 raise rpkgError('Could not check out %s' % branch)
+        # We are on another branch now
+        self._forget_gitstate()
         return
 
     def file_exists(self, pkg_name, filename, md5sum):
@@ -1565,23 +2297,18 @@ class Commands(object):
         if not url:
             # We don't have a url, so build from the latest commit
             # Check to see if the tree is dirty
-            if self.repo.is_dirty():
+            state = self.gitstate
+            if state['dirty']:
                 raise rpkgError('%s has uncommitted changes.  Use git status '
                                 'to see details' % self.path)
             # Need to check here to see if the local commit you want to build is
             # pushed or not
-            branch = self.repo.active_branch
-            try:
-                remote = self.repo.git.config('--get',
-                    'branch.%s.remote' % branch)
-
-                merge = self.repo.git.config('--get',
-                    'branch.%s.merge' % branch).replace('refs/heads', remote)
-                if self.repo.git.rev_list('%s...%s' % (branch, merge)):
-                    raise rpkgError('There are unpushed changes in your repo')
-            except git.GitCommandError:
+            if not state['remote'] or not state['merge'] or \
+            state['ahead'] is None:
                 raise rpkgError('You must provide a srpm or push your \
                                    changes to the remote repo.')
+            if state['ahead'] or state['behind']:
+                raise rpkgError('There are unpushed changes in your repo')
             url = self.anongiturl % {'module': self.module_name} + \
                 '?#%s' % self.commithash
         # Check to see if the target is valid
@@ -1681,47 +2408,88 @@ class Commands(object):
                                                             task_id))
         return task_id
 
+    def changelog(self, count=None):
+        """Return the count most recent spec changelog entries, or all
+
+        The spec is read one line at a time and only as far as needed, so
+        getting the latest entry is cheap however long the changelog is.
+        Returns a list of dicts, newest first, of:
+
+        date: the date of the entry, like 'Mon Oct 17 2011'
+        author: who wrote it, usually with an email address
+        evr: the [epoch:]version-release it is for, or None
+        lines: the text of the entry without its trailing blank lines
+
+        Lines starting with % or $ are skipped and %% becomes %.
+        """
+
+        entries = []
+        entry = None
+        incl = False
+        spec = open(os.path.join(self.path, self.spec), 'r')
+        try:
+            for line in spec:
+                if not incl:
+                    incl = line.lower().startswith('%changelog')
+                    continue
+                line = line.rstrip('\n')
+                if line.startswith('*'):
+                    if count is not None and len(entries) == count:
+                        break
+                    entry = self._changelog_header(line.replace('%%', '%'))
+                    entries.append(entry)
+                    continue
+                if entry is None or line.startswith(('%', '$')):
+                    continue
+                entry['lines'].append(line.replace('%%', '%'))
+        finally:
+            spec.close()
+        for entry in entries:
+            while entry['lines'] and not entry['lines'][-1].strip():
+                entry['lines'].pop()
+        return entries
+
+    def _changelog_header(self, line):
+        """Return a changelog entry for its '* date author - evr' line"""
+
+        fields = line.lstrip('*').split(None, 4)
+        date = ' '.join(fields[:4])
+        rest = len(fields) > 4 and fields[4] or ''
+        evr = None
+        if '>' in rest:
+            # Whatever follows the email address is the evr
+            author, evr = rest.rsplit('>', 1)
+            author += '>'
+            evr = evr.strip().lstrip('-').strip() or None
+        elif ' - ' in rest:
+            author, evr = rest.rsplit(' - ', 1)
+            evr = evr.strip() or None
+        else:
+            author = rest
+        return {'date': date, 'author': author.strip(), 'evr': evr,
+                'lines': []}
+
     def clog(self, raw=False):
         """Write the latest spec changelog entry to a clog file"""
 
-        # This is a little ugly.  We want to find where %changelog starts,
-        # then only deal with the content up to the first empty newline.
-        # Then remove any lines that start with $ or %, and then replace
-        # %% with %
-
-        cloglines = []
-        first = True
-        spec = open(os.path.join(self.path, self.spec), 'r').readlines()
-        for line in spec:
-            if line.lower().startswith('%changelog'):
-                # Grab all the lines below changelog
-                for line2 in spec[spec.index(line):]:
-                    if line2.startswith('\n'):
-                        break
-                    if line2.startswith('$'):
-                        continue
-                    if line2.startswith('%'):
-                        continue
-                    if line2.startswith('*'):
-                        if first:
-                            # skip the email n/v/r line.  Redundant
-                            continue
-                        # Otherwise what follows is the next entry
-                        break
-                    if first:
-                        if not raw:
-                            cloglines.append(line2.lstrip('- ').replace('%%',
-                                                                        '%'))
-                            cloglines.append("\n")
-                        else:
-                            cloglines.append(line2.replace('%%', '%'))
-                        first = False
-                    else:
-                        cloglines.append(line2.replace('%%', '%'))
-
-        # Now open the clog file and write out the lines
-        clogfile = open(os.path.join(self.path, 'clog'), 'w')
-        clogfile.writelines(cloglines)
+        # Only deal with the content of the latest entry up to the first
+        # empty line.  Unless raw, the leading '- ' of the first line is
+        # dropped and a blank line put after it, to make it a commit
+        # message summary.
+
+        text = []
+        for entry in self.changelog(1):
+            for line in entry['lines']:
+                if not line:
+                    break
+                text.append('%s\n' % line)
+        cloglines = text
+        if text and not raw:
+            cloglines = [text[0].lstrip('- '), '\n'] + text[1:]
+
+        # Now write out the lines, replacing any old clog in one go
+        write_atomic(os.path.join(self.path, 'clog'), ''.join(cloglines),
+                     self.fsync)
 
     def compile(self, arch=None, short=False, builddir=None):
         """Run rpm -bc on a module
@@ -1736,11 +2504,11 @@ class Commands(object):
         self.sources()
         # setup the rpm command
         cmd = ['rpmbuild']
-        if builddir:
-            # Tack on a new builddir to the end of the defines
-            self.rpmdefines.append("--define '_builddir %s'" %
-                                   os.path.abspath(builddir))
         cmd.extend(self.rpmdefines)
+        if builddir:
+            # Tack on a new builddir to the end of the defines, for this
+            # run only as the object may be reused
+            cmd.append("--define '_builddir %s'" % os.path.abspath(builddir))
         if arch:
             cmd.extend(['--target', arch])
         if short:
@@ -1758,7 +2526,172 @@ class Commands(object):
             '?#%s' % self.commithash
         return url
 
-    def koji_upload(self, file, path, callback=None):
+    # What info can report, in the order it reports them
+    info_fields = ['name', 'epoch', 'version', 'release', 'nvr', 'spec',
+                   'branch', 'disttag', 'target', 'commit', 'giturl']
+
+    def info(self, fields=None):
+        """Return a dict of facts about the module, for machine use
+
+        fields is a list of names from info_fields and defaults to all of
+        them.  Only what the fields need gets loaded, so asking for the spec
+        does not query rpm or git.
+        """
+
+        getters = {'name': lambda: self.module_name,
+                   'epoch': lambda: self.epoch,
+                   'version': lambda: self.ver,
+                   'release': lambda: self.rel,
+                   'nvr': lambda: self.nvr,
+                   'spec': lambda: self.spec,
+                   'branch': lambda: self.branch_merge,
+                   'disttag': lambda: self.disttag,
+                   'target': lambda: self.target,
+                   'commit': lambda: self.commithash,
+                   'giturl': self.giturl}
+        if not fields:
+            fields = self.info_fields
+        info = {}
+        for field in fields:
+            if field not in getters:
+                raise rpkgError('Unknown field %s, try one of %s' %
+                                (field, ', '.join(self.info_fields)))
+            info[field] = getters[field]()
+        return info
+
+    def _koji_upload_chunk(self, session, file, path, offset, blocksize):
+        """Send one chunk of file to the path on the hub over session
+
+        Returns the size of the chunk sent or raises
+        """
+
+        input = open(file, 'rb')
+        try:
+            input.seek(offset)
+            chunk = input.read(blocksize)
+        finally:
+            input.close()
+        digest = hashlib.md5(chunk).hexdigest()
+        # Chunks are checked against their md5 by the hub as they land
+        if not session.callMethod('uploadFile', path, os.path.basename(file),
+                                  koji.encode_int(len(chunk)), digest,
+                                  koji.encode_int(offset),
+                                  base64.encodestring(chunk)):
+            raise rpkgError('Error uploading %s at offset %s' % (file, offset))
+        return len(chunk)
+
+    def _koji_upload_state(self, file):
+        """Return the path recording the progress of uploading file"""
+
+        name = hashlib.sha1(os.path.abspath(file)).hexdigest()
+        return os.path.join(self.cachedir, 'upload', name)
+
+    def _save_json(self, filename, data):
+        """Write data out to filename as json, replacing it in one go
+
+        Failures are only logged, this is used for caches.
+        """
+
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            write_atomic(filename, json.dumps(data), fsync=False)
+        except (IOError, OSError), e:
+            self.log.debug('Could not save %s: %s' % (filename, e))
+
+    def _load_koji_uploads(self):
+        """Return the record of earlier uploads, keyed by sha256 digest"""
+
+        try:
+            return json.load(open(os.path.join(self.cachedir,
+                                               'koji-uploads.json'), 'r'))
+        except (IOError, ValueError):
+            return {}
+
+    def _upload_digest(self, file):
+        """Return the sha256 digest uploads of file are recorded by
+
+        The digest is kept while the file stays the same, so looking for an
+        earlier upload and recording a new one only hash it once.
+        """
+
+        info = os.stat(file)
+        key = (os.path.abspath(file), info.st_size, info.st_mtime)
+        if key not in self._upload_digests:
+            self._upload_digests[key] = self._hash_file(file, 'sha256')
+        return self._upload_digests[key]
+
+    def _record_koji_upload(self, file, path, digest=None, md5=None):
+        """Remember that file was uploaded to path on the hub
+
+        The md5 digest is kept too, for hubs that can't check sha256.
+        """
+
+        if not digest:
+            digest = self._upload_digest(file)
+        if not md5:
+            md5 = self._hash_file(file, 'md5')
+        uploads = self._load_koji_uploads()
+        # The hub cleans out its work dir, so forget about old uploads
+        for key in uploads.keys():
+            if uploads[key].get('time', 0) < time.time() - 30 * 86400:
+                del uploads[key]
+        uploads[digest] = {'server': self.kojisession.baseurl,
+                           'path': path, 'name': os.path.basename(file),
+                           'size': os.path.getsize(file), 'time': time.time(),
+                           'md5': md5}
+        self._save_json(os.path.join(self.cachedir, 'koji-uploads.json'),
+                        uploads)
+
+    def find_koji_upload(self, file):
+        """Find an earlier upload of the same content as file on the hub
+
+        Uploads are looked up by digest in a local record, and the hub is
+        asked to confirm the file is still there with the same checksum.
+        Hubs that can't check sha256 are asked for md5 instead, and the
+        checksum the hub took is remembered for next time.
+
+        Returns the path of the upload, or None if file has to be uploaded
+        """
+
+        digest = self._upload_digest(file)
+        uploads = self._load_koji_uploads()
+        entry = uploads.get(digest)
+        if not entry or entry.get('server') != self.kojisession.baseurl or \
+        entry.get('name') != os.path.basename(file):
+            return None
+        expected = {'sha256': digest, 'md5': entry.get('md5')}
+        verify = [csumtype for csumtype in ('sha256', 'md5')
+                  if expected[csumtype]]
+        # Start with the checksum the hub took last time
+        if entry.get('verify') in verify:
+            verify.remove(entry['verify'])
+            verify.insert(0, entry['verify'])
+        for csumtype in verify:
+            try:
+                info = self.kojisession.checkUpload(entry['path'],
+                                                    entry['name'],
+                                                    verify=csumtype)
+                break
+            except Exception, e:
+                self.log.debug('Could not check upload %s/%s with %s: %s' %
+                               (entry['path'], entry['name'], csumtype, e))
+        else:
+            # Older hubs can't tell us, so upload again to be safe
+            return None
+        if csumtype != entry.get('verify'):
+            entry['verify'] = csumtype
+            self._save_json(os.path.join(self.cachedir, 'koji-uploads.json'),
+                            uploads)
+        if not info or info.get('size') != entry['size'] or \
+        info.get('hexdigest') != expected[csumtype]:
+            self.log.debug('Upload %s/%s is gone from the hub' %
+                           (entry['path'], entry['name']))
+            return None
+        return str(entry['path'])
+
+    def koji_upload(self, file, path, callback=None, jobs=4, resume=True,
+                    blocksize=1048576):
         """Upload a file to koji
 
         file is the file you wish to upload
@@ -1767,7 +2700,19 @@ class Commands(object):
 
         callback is the progress callback to use, if any
 
-        Returns nothing or raises
+        jobs is the number of connections to send chunks over at once
+
+        resume is whether to continue an interrupted upload of the same file
+
+        The file is sent in chunks of blocksize bytes, spread over jobs
+        subsessions of the buildsystem.  Completed chunks are recorded in
+        the cache directory, so an interrupted upload of an unchanged file
+        only sends the missing chunks.  The hub verifies the size and
+        checksum of the whole file at the end.
+
+        Returns the path the file was uploaded to, which is the path of the
+        interrupted upload when resuming one, or a new one next to path when
+        a resumed upload had to be started over, or raises
         """
 
         # See if we actually have a file
@@ -1776,8 +2721,129 @@ class Commands(object):
         if not self.kojisession:
             raise rpkgError('No active %s session.' %
                             os.path.basename(self.build_client))
-        # This should have a try and catch koji errors
-        self.kojisession.uploadWrapper(file, path, callback=callback)
+
+        info = os.stat(file)
+        size = info.st_size
+        statefile = self._koji_upload_state(file)
+        state = {'server': self.kojisession.baseurl, 'path': path,
+                 'size': size, 'mtime': info.st_mtime,
+                 'blocksize': blocksize, 'started': time.time(), 'done': []}
+        if resume and os.path.exists(statefile):
+            try:
+                oldstate = json.load(open(statefile, 'r'))
+            except (IOError, ValueError):
+                oldstate = {}
+            # The hub cleans up stale uploads, so don't trust old ones.  The
+            # hub refuses a first chunk for a file it already has, so an
+            # upload is only resumed once its first chunk is known to have
+            # landed.
+            if oldstate.get('started', 0) > time.time() - 86400 and \
+            0 in oldstate.get('done', []) and \
+            [oldstate.get(key) for key in ('server', 'size', 'mtime',
+                                           'blocksize')] == \
+            [state[key] for key in ('server', 'size', 'mtime', 'blocksize')]:
+                self.log.info('Resuming upload of %s to %s' %
+                              (os.path.basename(file), oldstate['path']))
+                state = oldstate
+            else:
+                resume = False
+        else:
+            resume = False
+        path = str(state['path'])
+        done = set(state['done'])
+        offsets = [offset for offset in range(0, size, blocksize)
+                   if offset not in done]
+
+        lock = threading.Lock()
+        progress = {'uploaded': len(done) * blocksize, 'start': time.time()}
+        def sent(offset, piece, elapsed):
+            lock.acquire()
+            try:
+                state['done'].append(offset)
+                self._save_json(statefile, state)
+                progress['uploaded'] = min(progress['uploaded'] + piece, size)
+                if callback:
+                    callback(progress['uploaded'], size, piece, elapsed,
+                             time.time() - progress['start'])
+            finally:
+                lock.release()
+
+        local = threading.local()
+        sessions = []
+        def send(offset):
+            if not hasattr(local, 'session'):
+                local.session = self.kojisession.subsession()
+                lock.acquire()
+                sessions.append(local.session)
+                lock.release()
+            for attempt in range(3):
+                start = time.time()
+                try:
+                    piece = self._koji_upload_chunk(local.session, file,
+                                                    path, offset, blocksize)
+                    break
+                except Exception, e:
+                    self.log.debug('Upload of chunk at %s failed: %s' %
+                                   (offset, e))
+                    if attempt == 2:
+                        raise
+                # The hub only tries its locks on the file once, so give
+                # the other chunks a chance before trying again
+                time.sleep(2 ** attempt * (0.5 + random.random()))
+            sent(offset, piece, time.time() - start)
+
+        self._save_json(statefile, state)
+        try:
+            # The hub truncates the file when it gets the first chunk, so it
+            # has to land before any of the others.
+            if offsets and offsets[0] == 0:
+                start = time.time()
+                piece = self._koji_upload_chunk(self.kojisession, file, path,
+                                                0, blocksize)
+                sent(0, piece, time.time() - start)
+                offsets.pop(0)
+            results = self._run_parallel(send, offsets, jobs)
+        finally:
+            for session in sessions:
+                try:
+                    session.logout()
+                except Exception:
+                    pass
+        errors = [error for offset, result, error in results if error]
+        if errors:
+            raise rpkgError('Could not upload %s: %s.  Run again to resume.' %
+                            (file, errors[0]))
+
+        # Have the hub check the whole file
+        self.log.debug('Verifying upload of %s' % file)
+        md5 = self._hash_file(file, 'md5')
+        try:
+            verified = self.kojisession.callMethod('uploadFile', path,
+                                               os.path.basename(file),
+                                               koji.encode_int(size), md5,
+                                               koji.encode_int(-1), '')
+        except Exception, e:
+            self.log.debug('Hub could not verify %s: %s' % (file, e))
+            verified = False
+        if os.path.exists(statefile):
+            os.remove(statefile)
+        if not verified:
+            if resume:
+                # The partial upload may be gone from the hub or be missing
+                # chunks.  The verify call left a file at its path, so start
+                # over in a new one.
+                path = '%s/%r.%s' % (os.path.dirname(path) or 'cli-build',
+                                     time.time(),
+                                     ''.join([random.choice(
+                                              string.ascii_letters)
+                                              for i in range(8)]))
+                self.log.info('Resumed upload failed verification, '
+                              'uploading %s again' % os.path.basename(file))
+                return self.koji_upload(file, path, callback, jobs,
+                                        resume=False, blocksize=blocksize)
+            raise rpkgError('Upload of %s failed verification' % file)
+        self._record_koji_upload(file, path, md5=md5)
+        return path
 
     def install(self, arch=None, short=False, builddir=None):
         """Run rpm -bi on a module
@@ -1792,11 +2858,11 @@ class Commands(object):
         self.sources()
         # setup the rpm command
         cmd = ['rpmbuild']
-        if builddir:
-            # Tack on a new builddir to the end of the defines
-            self.rpmdefines.append("--define '_builddir %s'" %
-                                   os.path.abspath(builddir))
         cmd.extend(self.rpmdefines)
+        if builddir:
+            # Tack on a new builddir to the end of the defines, for this
+            # run only as the object may be reused
+            cmd.append("--define '_builddir %s'" % os.path.abspath(builddir))
         if arch:
             cmd.extend(['--target', arch])
         if short:
@@ -1808,12 +2874,61 @@ class Commands(object):
         self._run_command(cmd, shell=True)
         return
 
-    def lint(self, info=False, rpmlintconf=None):
+    def _lint_file(self, cmd, file):
+        """Run the rpmlint command cmd on file
+
+        Returns a tuple of the output with rpmlint's summary line taken out,
+        the counts from that summary as a list of packages, specfiles,
+        errors, warnings, filtered and badness, and the exit code.  The
+        last two are None when rpmlint does not report them.
+        """
+
+        self.log.debug('Running %s' % ' '.join(cmd + [file]))
+        try:
+            proc = subprocess.Popen(cmd + [file], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, cwd=self.path)
+            output = proc.communicate()[0]
+        except OSError, e:
+            raise rpkgError('Error running rpmlint: %s' % e)
+        lines = []
+        counts = None
+        for line in output.splitlines(True):
+            match = _lint_summary.match(line)
+            if match:
+                counts = [count and int(count) for count in match.groups()]
+            else:
+                lines.append(line)
+        if counts is None and proc.returncode not in (0, 64, 66):
+            raise rpkgError('rpmlint failed on %s: %s' %
+                            (os.path.basename(file), output.strip()))
+        return (''.join(lines), counts or [0, 0, 0, 0, None, None],
+                proc.returncode)
+
+    def _lint_version(self):
+        """Return the version rpmlint reports, or None if it can't say"""
+
+        try:
+            proc = subprocess.Popen(['rpmlint', '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        except OSError, e:
+            raise rpkgError('Error running rpmlint: %s' % e)
+        if proc.returncode:
+            return None
+        return output.strip()
+
+    def lint(self, info=False, rpmlintconf=None, jobs=None):
         """Run rpmlint over a built srpm
 
         Log the output and returns nothing
         rpmlintconf is the name of the config file passed to rpmlint if
         specified by the command line argument.
+
+        The spec, srpm and rpms are linted by up to jobs rpmlint processes
+        at once, defaulting to the number of cpus, and the output put back
+        together in that order.  The output for files that have not changed
+        since they were last linted with the same options is reused.
         """
 
         # Check for srpm
@@ -1829,23 +2944,92 @@ class Commands(object):
                 # For each available arch folder, lists file and keep
                 # those ending with .rpm
                 rpms.extend([os.path.join(self.path, arch, file) for file in
-                         os.listdir(os.path.join(self.path, arch))
+                         sorted(os.listdir(os.path.join(self.path, arch)))
                          if file.endswith('.rpm')])
         if not rpms:
             log.warn('No rpm found')
         cmd = ['rpmlint']
         if info:
             cmd.extend(['-i'])
+        conf = None
         if rpmlintconf:
-            cmd.extend(["-f", os.path.join(self.path, rpmlintconf)])
+            conf = os.path.join(self.path, rpmlintconf)
         elif os.path.exists(os.path.join(self.path, ".rpmlint")):
-            cmd.extend(["-f", os.path.join(self.path, ".rpmlint")])
-        cmd.append(os.path.join(self.path, self.spec))
+            conf = os.path.join(self.path, ".rpmlint")
+        if conf:
+            cmd.extend(["-f", conf])
+        files = [os.path.join(self.path, self.spec)]
         if os.path.exists(os.path.join(self.path, srpm)):
-            cmd.append(os.path.join(self.path, srpm))
-        cmd.extend(rpms)
-        # Run the command
-        self._run_command(cmd, shell=True)
+            files.append(os.path.join(self.path, srpm))
+        files.extend(rpms)
+
+        # Earlier results are good while the file, the options, the
+        # rpmlint version and the config files rpmlint reads stay the same
+        def state(file):
+            try:
+                info = os.stat(file)
+            except OSError:
+                return None
+            return [info.st_size, info.st_mtime]
+        configs = []
+        for pattern in _lint_configs:
+            configs.extend(sorted(glob.glob(os.path.expanduser(pattern))))
+        options = [cmd, self._lint_version(), conf and state(conf),
+                   [[config, state(config)] for config in configs]]
+        cachefile = os.path.join(self.cachedir, 'lint.json')
+        try:
+            cache = json.load(open(cachefile, 'r'))
+        except (IOError, ValueError):
+            cache = {}
+        results = {}
+        tolint = []
+        for file in files:
+            entry = cache.get(file)
+            if entry and entry['key'] == [options, state(file)]:
+                self.log.debug('%s is unchanged since it was last linted' %
+                               os.path.basename(file))
+                results[file] = entry['result']
+            else:
+                tolint.append(file)
+
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        failed = None
+        for file, result, error in self._run_parallel(
+                lambda file: self._lint_file(cmd, file), tolint, jobs):
+            if error:
+                failed = failed or error
+                continue
+            results[file] = result
+            cache[file] = {'key': [options, state(file)], 'result': result}
+        # Forget about files that are gone
+        for file in cache.keys():
+            if not os.path.exists(file):
+                del cache[file]
+        self._save_json(cachefile, cache)
+        if failed:
+            raise rpkgError(failed)
+
+        # Put the output back together in the order rpmlint would give it
+        output = ''.join([results[file][0] for file in files])
+        counts = [0, 0, 0, 0, None, None]
+        for file in files:
+            for index, count in enumerate(results[file][1]):
+                if count is not None:
+                    counts[index] = (counts[index] or 0) + count
+        output += _lint_summary_format % tuple(counts[:4])
+        if counts[4] is not None:
+            output += ', %d filtered' % counts[4]
+        if counts[5] is not None:
+            output += ', %d badness' % counts[5]
+        output += '.\n'
+
+        if sys.stdout.isatty():
+            sys.stdout.write(output)
+        else:
+            self.log.info(output)
+        if [file for file in files if results[file][2]]:
+            raise rpkgError('rpmlint found errors')
 
     def local(self, arch=None, hashtype=None, builddir=None):
         """rpmbuild locally for given arch.
@@ -1862,11 +3046,11 @@ class Commands(object):
         self.sources()
         # build up the rpm command
         cmd = ['rpmbuild']
-        if builddir:
-            # Tack on a new builddir to the end of the defines
-            self.rpmdefines.append("--define '_builddir %s'" %
-                                   os.path.abspath(builddir))
         cmd.extend(self.rpmdefines)
+        if builddir:
+            # Tack on a new builddir to the end of the defines, for this
+            # run only as the object may be reused
+            cmd.append("--define '_builddir %s'" % os.path.abspath(builddir))
         # Figure out the hash type to use
         if not hashtype:
             # Try to determine the dist
@@ -1884,11 +3068,29 @@ class Commands(object):
         # Run the command
         self._run_command(cmd, shell=True, pipe=['tee', logfile])
 
+    def _mock_config_repo(self, target):
+        """Return the build tag name and current repo id for a build target"""
+
+        # Figure out if we have a valid build target
+        build_target = self.anon_kojisession.getBuildTarget(target)
+        if not build_target:
+            raise rpkgError('Unknown build target: %s' % target)
+
+        try:
+            repoid = self.anon_kojisession.getRepo(
+                                build_target['build_tag_name'])['id']
+        except Exception:
+            raise rpkgError('Could not find a valid build repo')
+        return (build_target['build_tag_name'], repoid)
+
     # Not to be confused with mockconfig the property
-    def mock_config(self, target=None, arch=None):
+    def mock_config(self, target=None, arch=None, tag_name=None,
+                    repoid=None):
         """Generate a mock config based on branch data.
 
         Can use option target and arch to override autodiscovery.
+        The buildsystem is asked for the build tag and repo id unless
+        they are passed in as tag_name and repoid.
         Will return the mock config file text.
         """
 
@@ -1898,21 +3100,13 @@ class Commands(object):
         if not arch:
             arch = self.localarch
 
-        # Figure out if we have a valid build target
-        build_target = self.anon_kojisession.getBuildTarget(target)
-        if not build_target:
-            raise rpkgError('Unknown build target: %s' % target)
-
-        try:
-            repoid = self.anon_kojisession.getRepo(
-                                build_target['build_tag_name'])['id']
-        except Exception, e:
-            raise rpkgError('Could not find a valid build repo')
+        if not tag_name or not repoid:
+            tag_name, repoid = self._mock_config_repo(target)
 
         # Generate the config
         config = koji.genMockConfig('%s-%s' % (target, arch), arch,
                                    distribution=self.disttag,
-                                   tag_name=build_target['build_tag_name'],
+                                   tag_name=tag_name,
                                    repoid=repoid,
                                    topurl=self.topurl)
 
@@ -1943,136 +3137,264 @@ class Commands(object):
                                     ' file %s: %s'
                                     % (tmp_filename, error))
 
-    def _config_dir_basic(self, config_dir=None, root=None):
-        """Setup directory with essential mock config
+    def _config_dir_cached(self, root=None):
+        """Return a persistent mock config directory for root
 
-        If config directory doesn't exist it will be created. If temporary
-        directory was created by this method and error occours during
-        processing, temporary directory is removed. Otherwise it caller's
-        responsibility to remove this directory.
+        The directory lives under cachedir and is keyed by the root name,
+        which is made of the target and arch.  The build tag, repo id,
+        disttag and topurl the config was generated from are kept next to
+        it, so it can be revalidated with a single getRepo call.  The config
+        is only regenerated when one of those changes, which also lets mock
+        reuse its root cache between runs.
+
+        Returns the config directory
+        """
 
-        Returns used config directory"""
         if not root:
             root = self.mockconfig
-        if not config_dir:
-            my_config_dir = tempfile.mkdtemp(prefix="%s." % root,
-                                             suffix='mockconfig')
-            config_dir = my_config_dir
-            self.log.debug('New mock config directory: %s', config_dir)
-        else:
-            my_config_dir = None
+        config_dir = os.path.join(self.cachedir, 'mock', root)
+        config_file = os.path.join(config_dir, '%s.cfg' % root)
+        stamp_file = os.path.join(config_dir, 'repoid')
 
+        tag_name = None
+        repoid = None
+        if os.path.exists(config_file) and os.path.exists(stamp_file):
+            try:
+                stamp = json.load(open(stamp_file, 'r'))
+                tag_name = stamp['tag_name']
+                repoid = stamp['repoid']
+            except (IOError, ValueError, KeyError, TypeError):
+                tag_name = None
+            else:
+                if [stamp.get('disttag'), stamp.get('topurl')] != \
+                        [self.disttag, self.topurl]:
+                    self.log.debug('Mock config %s was made for another '
+                                   'disttag or topurl' % config_file)
+                    tag_name = None
+        if tag_name:
+            try:
+                current = self.anon_kojisession.getRepo(tag_name)['id']
+            except Exception:
+                current = None
+            if current == repoid:
+                self.log.debug('Reusing mock config %s for repo %s' %
+                               (config_file, repoid))
+                return config_dir
+            self.log.debug('Mock config %s is stale, regenerating' %
+                           config_file)
+
+        if not os.path.isdir(config_dir):
+            try:
+                os.makedirs(config_dir)
+            except OSError, error:
+                raise rpkgError('Could not create mock config directory'
+                                ' %s: %s' % (config_dir, error))
+        # Make sure a stale stamp can't validate a half written config
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
+        tag_name, repoid = self._mock_config_repo(self.target)
         try:
-            config_content = self.mock_config()
+            config_content = self.mock_config(tag_name=tag_name,
+                                              repoid=repoid)
         except rpkgError, error:
-            self._cleanup_tmp_dir(my_config_dir)
-            raise rpkgError('Could not generate config file: %s'
-                            % error)
-
-        config_file = os.path.join(config_dir, '%s.cfg' % root)
+            raise rpkgError('Could not generate config file: %s' % error)
+        # Each file is replaced in one go.  The stamp is written last on
+        # purpose, so an interrupted run leaves no stamp vouching for a
+        # config that was not completely written.
         try:
-            open(config_file, 'wb').write(config_content)
-        except IOError, error:
-            self._cleanup_tmp_dir(my_config_dir)
+            write_atomic(config_file, config_content, self.fsync)
+        except (IOError, OSError), error:
             raise rpkgError('Could not write config file: %s' % error)
-
+        self._config_dir_other(config_dir)
+        try:
+            write_atomic(stamp_file, json.dumps({'tag_name': tag_name,
+                                                 'repoid': repoid,
+                                                 'disttag': self.disttag,
+                                                 'topurl': self.topurl}),
+                         self.fsync)
+        except (IOError, OSError), error:
+            raise rpkgError('Could not write config stamp: %s' % error)
         return config_dir
 
-    def _cleanup_tmp_dir(self, tmp_dir):
-        """Tries to remove directory and ignores EEXIST error
-
-        If occoured directory not exist error (EEXIST) it silently continue.
-        Otherwise raise rpkgError exception."""
-        if not tmp_dir:
-            return
-        try:
-            shutil.rmtree(tmp_dir)
-        except OSError, error:
-            if error.errno != errno.EEXIST:
-                raise rpkgError('Failed to remove temporary directory'
-                                ' %s. Reason: %s.' % (tmp_dir, error))
+    def _mock_command(self, root, mockargs, resultdir, genconfig=False):
+        """Build the mock command line to rebuild our srpm in root
 
-    def mockbuild(self, mockargs=[], root=None, hashtype=None):
-        """Build the package in mock, using mockargs
+        If genconfig is set and root has no config in /etc/mock, a config
+        directory is taken from the cache or generated from the buildsystem.
 
-        Log the output and returns nothing
+        Returns the command as a list
         """
 
-        # Make sure we have an srpm to run on
-        self.srpm(hashtype=hashtype)
-
-        # setup the command
         cmd = ['mock']
         cmd.extend(mockargs)
         if self.quiet:
             cmd.append('--quiet')
 
-        config_dir = None
+        chroot_cfg = '/etc/mock/%s.cfg' % root
+        if genconfig and not os.path.exists(chroot_cfg):
+            self.log.debug('Mock config %s was not found. Going to'
+                           ' use a cached one from koji.', chroot_cfg)
+            try:
+                config_dir = self._config_dir_cached(root=root)
+            except rpkgError, error:
+                raise rpkgError('Failed to create mock config directory:'
+                                ' %s' % error)
+            self.log.debug('Cached mock config directory: %s', config_dir)
+            cmd.extend(['--configdir', config_dir])
+
+        cmd.extend(['-r', root, '--resultdir', resultdir,
+                    '--rebuild', self.srpmname])
+        return cmd
+
+    def mockbuild(self, mockargs=[], root=None, hashtype=None,
+                  force_srpm=False):
+        """Build the package in mock, using mockargs
+
+        force_srpm rebuilds the srpm even if its inputs are unchanged
+
+        Log the output and returns nothing
+        """
+
+        # Make sure we have an srpm to run on
+        self.srpm(hashtype=hashtype, force=force_srpm)
+
+        genconfig = False
         if not root:
             root = self.mockconfig
-            chroot_cfg = '/etc/mock/%s.cfg' % root
-            if not os.path.exists(chroot_cfg):
-                self.log.debug('Mock config %s was not found. Going to'
-                               ' request koji to create new one.', chroot_cfg)
-                try:
-                    config_dir = self._config_dir_basic(root=root)
-                except rpkgError, error:
-                    raise rpkgError('Failed to create mock config directory:'
-                                    ' %s' % error)
-                self.log.debug('Temporary mock config directory: %s',
-                               config_dir)
-                try:
-                    self._config_dir_other(config_dir)
-                except rpkgError, error:
-                    self._cleanup_tmp_dir(config_dir)
-                    raise rpkgError('Failed to populate mock config directory:'
-                                    ' %s' % error)
-                cmd.extend(['--configdir', config_dir])
-
-        cmd.extend(['-r', root, '--resultdir',
-                    os.path.join(self.path, "results_%s" % self.module_name,
-                                 self.ver, self.rel),
-                    '--rebuild', self.srpmname])
+            genconfig = True
+        resultdir = os.path.join(self.path, "results_%s" % self.module_name,
+                                 self.ver, self.rel)
+        cmd = self._mock_command(root, mockargs, resultdir,
+                                 genconfig=genconfig)
         # Run the command
+        self._run_command(cmd)
+
+    def _mockbuild_root(self, root, mockargs, genconfig=False):
+        """Rebuild our srpm in a single mock root, logging to a file
+
+        Used by mockbuild_roots, where several mock processes would otherwise
+        fight over the terminal.
+
+        Returns the result directory or raises
+        """
+
+        resultdir = os.path.join(self.path, "results_%s" % self.module_name,
+                                 self.ver, self.rel, root)
+        if not os.path.isdir(resultdir):
+            os.makedirs(resultdir)
+        cmd = self._mock_command(root, mockargs, resultdir,
+                                 genconfig=genconfig)
+        logfile = os.path.join(resultdir, 'mock.log')
+        self.log.info('Building in %s, logging to %s' % (root, logfile))
+        self.log.debug('Running %s' % ' '.join(cmd))
         try:
-            self._run_command(cmd)
-        finally:
-            self.log.debug('Cleaning up mock temporary config directory: %s',
-                           config_dir)
-            self._cleanup_tmp_dir(config_dir)
+            output = open(logfile, 'w')
+            try:
+                ret = subprocess.call(cmd, stdout=output,
+                                      stderr=subprocess.STDOUT)
+            finally:
+                output.close()
+        except (IOError, OSError), e:
+            raise rpkgError(e)
+        if ret:
+            raise rpkgError('mock returned code %s, see %s' % (ret, logfile))
+        return resultdir
 
-    def upload(self, files, replace=False):
-        """Upload source file(s) in the lookaside cache
+    def mockbuild_roots(self, roots, mockargs=[], hashtype=None, jobs=None,
+                        force_srpm=False):
+        """Build the package in several mock roots concurrently
 
-        Can optionally replace the existing tracked sources
+        The srpm is created once and then rebuilt in each of roots, running
+        at most jobs mock processes at a time (defaults to the number of
+        cpus).  Each root gets its own result directory holding the mock
+        output in mock.log, a root given more than once is built once.
+
+        Logs a report and returns a dict of root to a tuple of the result
+        directory and the error, one of which is None.
         """
 
-        oldpath = os.getcwd()
-        os.chdir(self.path)
+        # Make sure we have an srpm to run on
+        self.srpm(hashtype=hashtype, force=force_srpm)
+
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        # Two mock runs must not share a result directory
+        seen = set()
+        roots = [root for root in roots
+                 if not (root in seen or seen.add(root))]
+        # Only the default root gets a generated config, like mockbuild.
+        # Resolve it here rather than lazily from the worker threads.
+        try:
+            default_root = self.mockconfig
+        except rpkgError:
+            default_root = None
+        results = {}
+        for root, resultdir, error in self._run_parallel(
+                lambda root: self._mockbuild_root(root, mockargs,
+                                                  root == default_root),
+                roots, jobs):
+            results[root] = (resultdir, error)
+
+        self.log.info('Mock results:')
+        for root in roots:
+            resultdir, error = results[root]
+            if error:
+                self.log.info('  %s: FAILED (%s)' % (root, error))
+            else:
+                self.log.info('  %s: succeeded (%s)' % (root, resultdir))
+        return results
 
-        # Decide to overwrite or append to sources:
+    def _record_sources(self, entries, replace=False):
+        """Add uploaded files to sources and .gitignore and stage those
+
+        entries is a list of (hash, filename) tuples.  With replace they
+        make up the whole of the sources file, otherwise they are added to
+        it, replacing the hash of files already listed.
+        """
+
+        sources = SourcesFile(os.path.join(self.path, 'sources'),
+                              self.lookasidehash)
+        # Decide to overwrite or add to sources:
         if replace:
-            sources = []
-            sources_file = open('sources', 'w')
-        else:
-            sources = open('sources', 'r').readlines()
-            sources_file = open('sources', 'a')
+            sources.clear()
 
         # Will add new sources to .gitignore if they are not already there.
         gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
 
+        for file_hash, file_basename in entries:
+            sources.add(file_basename, file_hash)
+
+            # Add this file to .gitignore if it's not already there:
+            if not gitignore.match(file_basename):
+                gitignore.add('/%s' % file_basename)
+
+        # Always leave a sources file behind, even an empty one.  It goes
+        # first, as a source missing from .gitignore does no harm.
+        sources.write(force=not os.path.exists(sources.path),
+                      fsync=self.fsync)
+
+        # Write .gitignore with the new sources if anything changed:
+        gitignore.write(self.fsync)
+
+        rv = self.repo.index.add(['sources', '.gitignore'])
+
+    def upload(self, files, replace=False):
+        """Upload source file(s) in the lookaside cache
+
+        Can optionally replace the existing tracked sources
+
+        Relative file names are taken to be in our module directory.
+        """
+
+        entries = []
         uploaded = []
         for f in files:
+            f = os.path.join(self.path, f)
             # TODO: Skip empty file needed?
             file_hash = self._hash_file(f, self.lookasidehash)
             self.log.info("Uploading: %s  %s" % (file_hash, f))
             file_basename = os.path.basename(f)
-            if not "%s  %s\n" % (file_hash, file_basename) in sources:
-                sources_file.write("%s  %s\n" % (file_hash, file_basename))
-
-            # Add this file to .gitignore if it's not already there:
-            if not gitignore.match(file_basename):
-                gitignore.add('/%s' % file_basename)
+            entries.append((file_hash, file_basename))
 
             if self.file_exists(self.module_name, file_basename, file_hash):
                 # Already uploaded, skip it:
@@ -2087,15 +3409,8 @@ class Commands(object):
                 self._do_curl(file_hash, f)
                 uploaded.append(file_basename)
 
-        sources_file.close()
-
-        # Write .gitignore with the new sources if anything changed:
-        gitignore.write()
-
-        rv = self.repo.index.add(['sources', '.gitignore'])
-
-        # Change back to original working dir:
-        os.chdir(oldpath)
+        # Record them once everything is up
+        self._record_sources(entries, replace)
 
         # Log some info
         self.log.info('Uploaded and added to .gitignore: %s' %
@@ -2114,11 +3429,11 @@ class Commands(object):
         self.sources()
         # setup the rpm command
         cmd = ['rpmbuild']
-        if builddir:
-            # Tack on a new builddir to the end of the defines
-            self.rpmdefines.append("--define '_builddir %s'" %
-                                   os.path.abspath(builddir))
         cmd.extend(self.rpmdefines)
+        if builddir:
+            # Tack on a new builddir to the end of the defines, for this
+            # run only as the object may be reused
+            cmd.append("--define '_builddir %s'" % os.path.abspath(builddir))
         if arch:
             cmd.extend(['--target', arch])
         if self.quiet:
@@ -2127,58 +3442,88 @@ class Commands(object):
         # Run the command
         self._run_command(cmd, shell=True)
 
-    def srpm(self, hashtype=None):
+    def srpm(self, hashtype=None, force=False):
         """Create an srpm using hashtype from content in the module
 
         Requires sources already downloaded.
+
+        An existing srpm is reused if it was built from the same spec,
+        tracked files, sources, rpm defines and hashtype, unless force is set.
         """
 
         self.srpmname = os.path.join(self.path,
                             "%s-%s-%s.src.rpm" % (self.module_name,
                                                   self.ver, self.rel))
+        # Figure out which hashtype to use, if not provided one
+        if not hashtype:
+            # Try to determine the dist
+            hashtype = self._guess_hashtype()
+        fingerprint = self._srpm_fingerprint(hashtype)
+        stamp = self._srpm_stamp(self.srpmname)
         # See if we need to build the srpm
         if os.path.exists(self.srpmname):
+            info = os.stat(self.srpmname)
+            current = '%s %s %s\n' % (fingerprint, info.st_size,
+                                      info.st_mtime)
+            if not force and fingerprint and os.path.exists(stamp) and \
+                    open(stamp, 'r').read() == current:
+                self.log.info('Srpm %s is up to date, reusing it.' %
+                              os.path.basename(self.srpmname))
+                return
             self.log.debug('Srpm found, rewriting it.')
 
         cmd = ['rpmbuild']
         cmd.extend(self.rpmdefines)
         if self.quiet:
             cmd.append('--quiet')
-        # Figure out which hashtype to use, if not provided one
-        if not hashtype:
-            # Try to determine the dist
-            hashtype = self._guess_hashtype()
         # This may need to get updated if we ever change our checksum default
         if not hashtype == 'sha256':
             cmd.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
                     "--define '_binary_filedigest_algorithm %s'" % hashtype])
         cmd.extend(['--nodeps', '-bs', os.path.join(self.path, self.spec)])
+        if os.path.exists(stamp):
+            os.remove(stamp)
         self._run_command(cmd, shell=True)
 
+        # Remember what went into this srpm so the next run can reuse it
+        if fingerprint and os.path.exists(self.srpmname):
+            info = os.stat(self.srpmname)
+            try:
+                if not os.path.isdir(os.path.dirname(stamp)):
+                    os.makedirs(os.path.dirname(stamp))
+                write_atomic(stamp, '%s %s %s\n' % (fingerprint,
+                                                    info.st_size,
+                                                    info.st_mtime),
+                             fsync=False)
+            except (IOError, OSError), e:
+                self.log.debug('Could not record srpm fingerprint: %s' % e)
+
     def unused_patches(self):
         """Discover patches checked into source control that are not used
 
         Returns a list of unused patches, which may be empty.
         """
 
-        # Create a list for unused patches
-        unused = []
-        # Get the content of spec into memory for fast searching
-        spec = open(self.spec, 'r').read()
-        # Replace %{name} with the package name
-        spec = spec.replace("%{name}", self.module_name)
-        # Replace %{version} with the package version
-        spec = spec.replace("%{version}", self.ver)
-
-        # Get a list of files tracked in source control
-        files = self.repo.git.ls_files('--exclude-standard').split()
-        for file in files:
-            # throw out non patches
-            if not file.endswith(('.patch','.diff')):
-                continue
-            if file not in spec:
-                unused.append(file)
-        return unused
+        # Ask rpm which patches the spec uses, with all macros expanded
+        used = self._spec_patches()
+
+        # Get a list of files tracked in source control, and the ones kept
+        # in the lookaside
+        files = self.repo.git.ls_files('--exclude-standard').split('\n')
+        sources = SourcesFile(os.path.join(self.path, 'sources'),
+                              self.lookasidehash)
+        files.extend([file for file, csumtype, csum in sources])
+        # rpm only sees the patches of this arch and of the conditionals
+        # that hold here, so a patch the spec text names counts as used too
+        spec = open(os.path.join(self.path, self.spec), 'r').read()
+        for macro in ('%{name}', '%name'):
+            spec = spec.replace(macro, self.module_name)
+        for macro in ('%{version}', '%version'):
+            spec = spec.replace(macro, self.ver)
+        # throw out non patches and the ones in use
+        return [file for file in files
+                if file.endswith(('.patch','.diff')) and file not in used
+                and file not in spec]
 
     def verify_files(self, builddir=None):
         """Run rpmbuild -bl on a module to verify the %files section
@@ -2188,17 +3533,50 @@ class Commands(object):
 
         # setup the rpm command
         cmd = ['rpmbuild']
-        if builddir:
-            # Tack on a new builddir to the end of the defines
-            self.rpmdefines.append("--define '_builddir %s'" %
-                                   os.path.abspath(builddir))
         cmd.extend(self.rpmdefines)
+        if builddir:
+            # Tack on a new builddir to the end of the defines, for this
+            # run only as the object may be reused
+            cmd.append("--define '_builddir %s'" % os.path.abspath(builddir))
         if self.quiet:
             cmd.append('--quiet')
         cmd.extend(['-bl', os.path.join(self.path, self.spec)])
         # Run the command
         self._run_command(cmd, shell=True)
 
+# The summary rpmlint ends its output with.  rpmlint 2 adds the filtered
+# and badness counts, and frames the line with = signs.
+_lint_summary = re.compile(r'^[= ]*(\d+) packages and (\d+) specfiles '
+                           r'checked; (\d+) errors?, (\d+) warnings?'
+                           r'(?:, (\d+) filtered)?(?:, (\d+) badness)?[.;]')
+_lint_summary_format = '%d packages and %d specfiles checked; ' \
+                       '%d errors, %d warnings'
+
+# The config files rpmlint 1 and 2 read besides the one given to it
+_lint_configs = ['/etc/rpmlint/*', '/usr/share/rpmlint/*',
+                 '/etc/xdg/rpmlint/*', '~/.config/rpmlint*', '~/.rpmlintrc']
+
+# A lock for each mirror, so threads don't update the same one at once
+_mirror_locks = {}
+_mirror_locks_lock = threading.Lock()
+
+# The imports handed to the import_srpms worker processes
+_import_jobs = []
+
+def _import_srpm_job(index):
+    """Run one of the imports of import_srpms in a worker process
+
+    Returns a tuple of the archives to upload, with their full paths, and
+    the error as a string or None.
+    """
+
+    cmd, srpm = _import_jobs[index]
+    try:
+        files = cmd.import_srpm(srpm)
+    except Exception, e:
+        return ([], str(e) or e.__class__.__name__)
+    return ([os.path.join(cmd.path, file) for file in files], None)
+
 class GitIgnore(object):
     """ Smaller wrapper for managing a .gitignore file and it's entries. """
 
@@ -2214,15 +3592,36 @@ class GitIgnore(object):
         # Lines of the .gitignore file, used to check if entries need to be added
         # or already exist.
         self.__lines = []
+        # The same lines as a set, for the duplicate check
+        self.__linesset = set()
+        # Entries without glob characters, which match only themselves
+        self.__literals = set()
+        # Entries with glob characters, and a regex matching any of them
+        # that is compiled when first needed
+        self.__globs = []
+        self.__pattern = None
         if os.path.exists(self.path):
             gitignore_file = open(self.path, 'r')
-            self.__lines = gitignore_file.readlines()
+            for line in gitignore_file.readlines():
+                self.__index(line)
             gitignore_file.close()
 
         # Set to True if we end up making any modifications, used to
         # prevent unnecessary writes.
         self.modified = False
 
+    def __index(self, line):
+        """Keep a line and index it for add and match"""
+
+        self.__lines.append(line)
+        self.__linesset.add(line)
+        entry = line.lstrip('/').rstrip('\n')
+        if '*' in entry or '?' in entry or '[' in entry:
+            self.__globs.append(entry)
+            self.__pattern = None
+        else:
+            self.__literals.add(entry)
+
     def add(self, line):
         """
         Add a line to .gitignore, but check if it's a duplicate first.
@@ -2233,22 +3632,140 @@ class GitIgnore(object):
             line = "%s\n" % line
 
         # Add this line if it doesn't already exist:
-        if not line in self.__lines:
-            self.__lines.append(line)
+        if not line in self.__linesset:
+            self.__index(line)
             self.modified = True
 
     def match(self, line):
         line = line.lstrip('/').rstrip('\n')
-        for entry in self.__lines:
-            entry = entry.lstrip('/').rstrip('\n')
-            if fnmatch.fnmatch(line, entry):
-                return True
-        return False
+        if line in self.__literals:
+            return True
+        if not self.__globs:
+            return False
+        if self.__pattern is None:
+            # One regex for all the globs, the way fnmatch would match them
+            self.__pattern = re.compile('|'.join(['(?:%s)' %
+                                                  fnmatch.translate(entry)
+                                                  for entry in self.__globs]))
+        return self.__pattern.match(line) is not None
+
+    def write(self, fsync=True):
+        """ Write the new .gitignore file if any modifications were made.
 
-    def write(self):
-        """ Write the new .gitignore file if any modifications were made. """
+        The file is replaced in one go, see utils.AtomicFile.
+        """
         if self.modified:
-            gitignore_file = open(self.path, 'w')
-            for line in self.__lines:
-                gitignore_file.write(line)
-            gitignore_file.close()
+            write_atomic(self.path, ''.join(self.__lines), fsync)
+            self.modified = False
+
+class SourcesFile(object):
+    """ Parsed sources file, indexed by file name. """
+
+    # Lines like "SHA512 (foo.tar.gz) = <digest>" name their hash type
+    _tagged = re.compile(r'^(\w+) \((.+)\) = ([0-9a-fA-F]+)$')
+
+    def __init__(self, path, hashtype):
+        """
+        Create SourcesFile object for the given full path to a sources file.
+
+        hashtype is the hash type of lines that do not name one, which is
+        also used for new entries.  The file does not have to exist yet.
+        Raises rpkgError if it is malformed.
+        """
+
+        self.path = path
+        self.hashtype = hashtype
+        # File names in the order of the file, and their hash type and digest
+        self.__files = []
+        self.__entries = {}
+        if os.path.exists(self.path):
+            sources_file = open(self.path, 'r')
+            for line in sources_file:
+                line = line.strip()
+                if not line:
+                    continue
+                match = self._tagged.match(line)
+                if match:
+                    hashtype, file, digest = match.groups()
+                    self.add(file, digest, hashtype.lower())
+                    continue
+                try:
+                    # This strip / split is kind a ugly, but checksums
+                    # shouldn't have two spaces in them.
+                    digest, file = line.split('  ', 1)
+                except ValueError:
+                    sources_file.close()
+                    raise rpkgError('Malformed sources file.')
+                self.add(file, digest)
+            sources_file.close()
+
+        # Set to True if we end up making any modifications, used to
+        # prevent unnecessary writes.
+        self.modified = False
+
+    def __contains__(self, file):
+        return file in self.__entries
+
+    def __iter__(self):
+        """ Iterate over (file, hashtype, digest) in file order. """
+
+        for file in self.__files:
+            hashtype, digest = self.__entries[file]
+            yield (file, hashtype, digest)
+
+    def __len__(self):
+        return len(self.__files)
+
+    def get(self, file):
+        """ Return the (hashtype, digest) of file, or None. """
+
+        return self.__entries.get(file)
+
+    def add(self, file, digest, hashtype=None):
+        """
+        Set the digest of file, keeping its place if it is already listed.
+        """
+
+        entry = (hashtype or self.hashtype, digest)
+        if file not in self.__entries:
+            self.__files.append(file)
+        elif self.__entries[file] == entry:
+            return
+        self.__entries[file] = entry
+        self.modified = True
+
+    def remove(self, file):
+        """ Drop file from the sources. """
+
+        if file in self.__entries:
+            del self.__entries[file]
+            self.__files.remove(file)
+            self.modified = True
+
+    def clear(self):
+        """ Drop all the files. """
+
+        if self.__files:
+            self.__files = []
+            self.__entries = {}
+            self.modified = True
+
+    def write(self, force=False, fsync=True):
+        """
+        Write the sources file if any modifications were made, or if force.
+
+        The new file is written next to the old one and renamed over it, so
+        readers never see a partial file.  fsync makes sure it is on disk.
+        """
+
+        if not self.modified and not force:
+            return
+        lines = []
+        for file, hashtype, digest in self:
+            if hashtype == self.hashtype:
+                lines.append('%s  %s\n' % (digest, file))
+            else:
+                lines.append('%s (%s) = %s\n' % (hashtype.upper(), file,
+                                                 digest))
+        write_atomic(self.path, ''.join(lines), fsync)
+        self.modified = False
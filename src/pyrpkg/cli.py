@@ -13,15 +13,19 @@
 # LGPLv2.1.  See comments before those functions.
 
 import argparse
+import json
 import sys
 import os
 import logging
 import time
 import random
 import string
-import xmlrpclib
 import pwd
-import koji
+from utils import LazyModule
+
+# Only needed when building, see pyrpkg for why these are lazy
+koji = LazyModule('koji')
+xmlrpclib = LazyModule('xmlrpclib')
 
 class cliClient(object):
     """This is a client class for rpkg clients."""
@@ -41,11 +45,13 @@ class cliClient(object):
         self._module = None
         # Setup the base argparser
         self.setup_argparser()
-        # Add a subparser
-        self.subparsers = self.parser.add_subparsers(title = 'Targets',
+        # Add a subparser.  The command parsers are only recorded as they are
+        # registered, and built when parse_cmdline knows which are needed.
+        self.subparsers = LazySubParsers(self.parser.add_subparsers(
+                                                 title = 'Targets',
                                                  description = 'These are '
                                                  'valid commands you can '
-                                                 'ask %s to do' % self.name)
+                                                 'ask %s to do' % self.name))
         # Register all the commands
         self.setup_subparsers()
 
@@ -86,7 +92,8 @@ class cliClient(object):
                                        user=self.args.user,
                                        dist=self.args.dist,
                                        target=target,
-                                       quiet=self.args.q)
+                                       quiet=self.args.q,
+                                       mirrordir=items.get('anongitmirror'))
 
     # This function loads the extra stuff once we figure out what site
     # we are
@@ -133,6 +140,11 @@ class cliClient(object):
                                  help = 'Run with verbose debug output')
         self.parser.add_argument('-q', action = 'store_true',
                                  help = 'Run quietly only displaying errors')
+        # Hand the command to a running server
+        self.parser.add_argument('--connect', default=None,
+                                 help='Run the command in the rpkg server '
+                                 'listening on this socket (defaults to '
+                                 '$RPKG_SOCKET)')
 
     def setup_subparsers(self):
         """Setup basic subparsers that all clients should use"""
@@ -145,9 +157,12 @@ class cliClient(object):
         # Add a common parsers
         self.register_build_common()
         self.register_rpm_common()
+        self.register_json_common()
 
         # Other targets
+        self.register_batch()
         self.register_build()
+        self.register_bulk_import()
         self.register_chainbuild()
         self.register_clean()
         self.register_clog()
@@ -171,6 +186,7 @@ class cliClient(object):
         self.register_pull()
         self.register_push()
         self.register_scratch_build()
+        self.register_server()
         self.register_sources()
         self.register_srpm()
         self.register_switch_branch()
@@ -222,6 +238,49 @@ class cliClient(object):
         self.rpm_parser_common.add_argument('--arch',
                                             help='Prep for a specific arch')
 
+    def register_batch(self):
+        """Register the batch target"""
+
+        batch_parser = self.subparsers.add_parser('batch',
+                                        help = 'Run commands read from stdin',
+                                        description = 'Read requests from \
+                                        stdin, one json object per line like \
+                                        {"id": 1, "command": "verrel", \
+                                        "path": "~/pkgs/foo", "args": [], \
+                                        "options": ["--dist", "f16"]}, and \
+                                        run them in this process.  A json \
+                                        line with the id, exit code, stdout \
+                                        and stderr is written for each \
+                                        request as it finishes.  Requests on \
+                                        different paths run in parallel, \
+                                        those on the same path in order.')
+        batch_parser.add_argument('--jobs', '-j', type = int, default = 4,
+                                  help = 'Number of paths to work on at once')
+        batch_parser.set_defaults(command = self.batch)
+
+    def register_json_common(self):
+        """Create common parsers for commands with machine readable output"""
+
+        self.json_parser_common = argparse.ArgumentParser('json_common',
+                                                          add_help=False)
+        self.json_parser_common.add_argument('--json', action='store_true',
+                                             default=False,
+                                             help='Print the result as json')
+        # The informational commands can print any of the module facts
+        self.info_parser_common = argparse.ArgumentParser('info_common',
+                                        add_help=False,
+                                        parents=[self.json_parser_common])
+        self.info_parser_common.add_argument('--field', action='append',
+                                             dest='fields', default=None,
+                                             metavar='FIELD',
+                                             help='Print this instead of the \
+                                             default fields, implies --json. \
+                                             Can be given more than once, \
+                                             any of name, epoch, version, \
+                                             release, nvr, spec, branch, \
+                                             disttag, target, commit and \
+                                             giturl')
+
     def register_build(self):
         """Register the build target"""
 
@@ -244,8 +303,37 @@ class cliClient(object):
                                   help = 'Build from an srpm.  If no srpm \
                                   is provided with this option an srpm will \
                                   be generated from current module content.')
+        build_parser.add_argument('--force-srpm', action = 'store_true',
+                                  default = False,
+                                  help = 'Regenerate the srpm even if its \
+                                  inputs have not changed')
+        build_parser.add_argument('--upload-jobs', type = int, default = 4,
+                                  help = 'Number of connections to upload \
+                                  the srpm over')
         build_parser.set_defaults(command = self.build)
 
+    def register_bulk_import(self):
+        """Register the bulk-import target"""
+
+        bulk_import_parser = self.subparsers.add_parser('bulk-import',
+                                    help = 'Import a directory of srpms',
+                                    description = 'This imports each srpm \
+                                    in a directory into the checkout of its \
+                                    module, a directory named after the \
+                                    package in the current directory (or \
+                                    --path).  Imports run in parallel, and \
+                                    the new source archives of all packages \
+                                    are uploaded together afterwards.  The \
+                                    changes are staged but not committed.')
+        bulk_import_parser.add_argument('--jobs', '-j', type = int,
+                                        default = None,
+                                        help = 'Number of imports to run at \
+                                        once (defaults to the number of \
+                                        cpus)')
+        bulk_import_parser.add_argument('srpmdir',
+                                        help = 'Directory of srpms to import')
+        bulk_import_parser.set_defaults(command = self.bulk_import)
+
     def register_chainbuild(self):
         """Register the chain build target"""
 
@@ -318,11 +406,22 @@ defined, packages will be built sequentially.""" %
                                          By default it will also checkout \
                                          the master branch for your working \
                                          copy.')
-        # Allow an old style clone with subdirs for branches
-        clone_parser.add_argument('--branches', '-B',
+        # Allow an old style clone with subdirs for branches.  The branch
+        # subdirs are cloned locally from a bare clone, which can't be
+        # shallow.
+        clone_layout = clone_parser.add_mutually_exclusive_group()
+        clone_layout.add_argument('--branches', '-B',
                                   action = 'store_true',
                                   help = 'Do an old style checkout with \
                                   subdirs for branches')
+        # Share objects between the branch subdirs
+        clone_parser.add_argument('--shared', action = 'store_true',
+                                  help = 'With --branches, keep the bare \
+                                  clone as rpkg.git and share its objects \
+                                  with the branch subdirs')
+        clone_parser.add_argument('--jobs', '-j', type = int, default = None,
+                                  help = 'Number of git clones to run at \
+                                  once (defaults to the number of cpus)')
         # provide a convenient way to get to a specific branch
         clone_parser.add_argument('--branch', '-b',
                                   help = 'Check out a specific branch')
@@ -330,9 +429,19 @@ defined, packages will be built sequentially.""" %
         clone_parser.add_argument('--anonymous', '-a',
                                   action = 'store_true',
                                   help = 'Check out a module anonymously')
+        # Make cheaper clones of many modules
+        clone_layout.add_argument('--depth', type = int, default = None,
+                                  help = 'Make a shallow clone with this \
+                                  many commits of history')
+        clone_parser.add_argument('--reference', default = None,
+                                  help = 'Directory of local repos named \
+                                  <module>.git to borrow objects from')
+        clone_parser.add_argument('--from-file', '-f', default = None,
+                                  help = 'Read the modules to clone from \
+                                  this file, one per line')
         # store the module to be cloned
-        clone_parser.add_argument('module', nargs = 1,
-                                  help = 'Name of the module to clone')
+        clone_parser.add_argument('module', nargs = '*',
+                                  help = 'Name of the module(s) to clone')
         clone_parser.set_defaults(command = self.clone)
 
         # Add an alias for historical reasons
@@ -445,6 +554,7 @@ defined, packages will be built sequentially.""" %
         """Register the gimmespec target"""
 
         gimmespec_parser = self.subparsers.add_parser('gimmespec',
+                                         parents = [self.info_parser_common],
                                          help = 'Print the spec file name')
         gimmespec_parser.set_defaults(command = self.gimmespec)
 
@@ -466,6 +576,7 @@ defined, packages will be built sequentially.""" %
         """Register the giturl target"""
 
         giturl_parser = self.subparsers.add_parser('giturl',
+                                          parents = [self.info_parser_common],
                                           help = 'Print the git url for '
                                           'building',
                                           description = 'This will show you \
@@ -534,6 +645,9 @@ defined, packages will be built sequentially.""" %
                                  default = None,
                                  help = 'Use a specific configuration file \
                                  for rpmlint')
+        lint_parser.add_argument('--jobs', '-j', type = int, default = None,
+                                 help = 'Number of rpmlint processes to run \
+                                 at once (defaults to the number of cpus)')
         lint_parser.set_defaults(command = self.lint)
 
     def register_local(self):
@@ -558,6 +672,7 @@ defined, packages will be built sequentially.""" %
         """Register the new target"""
 
         new_parser = self.subparsers.add_parser('new',
+                                       parents = [self.json_parser_common],
                                        help = 'Diff against last tag',
                                        description = 'This will use git to \
                                        show a diff of all the changes \
@@ -577,10 +692,23 @@ defined, packages will be built sequentially.""" %
                                using the global --dist option. Your \
                                user must be in the local "mock" group.',
                                epilog='If config file for mock isn\'t found in \
-                               /etc/mock directory, temporary config directory \
-                               for mock is created and populated with config \
-                               file created with mock-config.')
-        mockbuild_parser.add_argument('--root', help='Override mock root')
+                               /etc/mock directory, a config directory for \
+                               mock is created and populated with config \
+                               file created with mock-config.  It is kept \
+                               under ~/.cache/rpkg/mock and only regenerated \
+                               when the build repo changes.')
+        mockbuild_parser.add_argument('--root', action='append',
+                                      help='Override mock root.  Can be '
+                                      'given several times to build in '
+                                      'each root concurrently')
+        mockbuild_parser.add_argument('--force-srpm', action='store_true',
+                                      default=False,
+                                      help='Regenerate the srpm even if its '
+                                      'inputs have not changed')
+        mockbuild_parser.add_argument('--jobs', '-j', type=int, default=None,
+                                      help='Number of mock roots to build in '
+                                      'at once (defaults to the number of '
+                                      'cpus)')
         # Allow the user to just pass "--md5" which will set md5 as the
         # hash, otherwise use the default of sha256
         mockbuild_parser.add_argument('--md5', action='store_const',
@@ -635,6 +763,12 @@ defined, packages will be built sequentially.""" %
                           Saves old patch file with a suffix of ~',
                           action = 'store_true',
                           default = False)
+        patch_parser.add_argument('--native',
+                          help = 'Make the diff in process instead of with \
+                          gendiff.  Hunks do not name the function they are \
+                          in.',
+                          action = 'store_true',
+                          default = False)
         patch_parser.add_argument('suffix',
                                   help = 'Look for files with this suffix \
                                   to diff')
@@ -702,8 +836,36 @@ defined, packages will be built sequentially.""" %
                                   help = 'Build from an srpm.  If no srpm \
                                   is provided with this option an srpm will \
                                   be generated from current module content.')
+        scratch_build_parser.add_argument('--force-srpm',
+                                  action = 'store_true', default = False,
+                                  help = 'Regenerate the srpm even if its \
+                                  inputs have not changed')
+        scratch_build_parser.add_argument('--upload-jobs', type = int,
+                                  default = 4,
+                                  help = 'Number of connections to upload \
+                                  the srpm over')
         scratch_build_parser.set_defaults(command = self.scratch_build)
 
+    def register_server(self):
+        """Register the server target"""
+
+        server_parser = self.subparsers.add_parser('server',
+                                        help = 'Run commands for clients '
+                                        'on a unix socket',
+                                        description = 'This starts a long \
+                                        running process that runs the \
+                                        commands sent to it with the global \
+                                        --connect option, or with \
+                                        $RPKG_SOCKET set.  It keeps the \
+                                        build system sessions and the data \
+                                        of each checkout around between \
+                                        commands.  Commands are run one at a \
+                                        time, without access to the \
+                                        client\'s stdin or environment.')
+        server_parser.add_argument('--socket', required = True,
+                                   help = 'Path of the socket to listen on')
+        server_parser.set_defaults(command = self.server)
+
     def register_sources(self):
         """Register the sources target"""
 
@@ -724,6 +886,10 @@ defined, packages will be built sequentially.""" %
         srpm_parser.add_argument('--md5', action='store_const',
                               const='md5', default=None, dest='hash',
                               help='Use md5 checksums (for older rpm hosts)')
+        srpm_parser.add_argument('--force', action='store_true',
+                                 default=False, dest='force_srpm',
+                                 help='Rebuild the srpm even if its inputs '
+                                 'have not changed')
         srpm_parser.set_defaults(command = self.srpm)
 
     def register_switch_branch(self):
@@ -752,6 +918,7 @@ defined, packages will be built sequentially.""" %
         """Register the tag target"""
 
         tag_parser = self.subparsers.add_parser('tag',
+                                       parents = [self.json_parser_common],
                                        help = 'Management of git tags',
                                        description = 'This command uses git \
                                        to create, list, or delete tags.')
@@ -831,6 +998,7 @@ defined, packages will be built sequentially.""" %
     def register_verrel(self):
 
         verrel_parser = self.subparsers.add_parser('verrel',
+                                        parents = [self.info_parser_common],
                                                    help = 'Print the '
                                                    'name-version-release')
         verrel_parser.set_defaults(command = self.verrel)
@@ -839,6 +1007,11 @@ defined, packages will be built sequentially.""" %
     def usage(self):
         self.parser.print_help()
 
+    def batch(self):
+        import server
+        if server.rpkgBatch(self, self.args.jobs).process(sys.stdin):
+            return 1
+
     def build(self, sets=None):
         # We may have gotten arches by way of scratch build, so handle them
         arches = None
@@ -864,15 +1037,27 @@ defined, packages will be built sequentially.""" %
             callback = None
             if not self.args.q:
                 callback = self._progress_callback
-            # define a unique path for this upload.  Stolen from /usr/bin/koji
-            uniquepath = 'cli-build/%r.%s' % (time.time(),
+            # Don't send the srpm again if the hub still has it from an
+            # earlier build
+            uniquepath = self.cmd.find_koji_upload(self.args.srpm)
+            if uniquepath:
+                self.log.info('Reusing earlier upload of %s' %
+                              os.path.basename(self.args.srpm))
+            else:
+                # define a unique path for this upload.  Stolen from
+                # /usr/bin/koji
+                uniquepath = 'cli-build/%r.%s' % (time.time(),
                                  ''.join([random.choice(string.ascii_letters)
                                           for i in range(8)]))
-            # Should have a try here, not sure what errors we'll get yet though
-            self.cmd.koji_upload(self.args.srpm, uniquepath, callback=callback)
-            if not self.args.q:
-                # print an extra blank line due to callback oddity
-                print('')
+                # Should have a try here, not sure what errors we'll get yet
+                # though.  An interrupted upload of the same srpm is resumed
+                # in its original path
+                uniquepath = self.cmd.koji_upload(self.args.srpm, uniquepath,
+                                                  callback=callback,
+                                                  jobs=self.args.upload_jobs)
+                if not self.args.q:
+                    # print an extra blank line due to callback oddity
+                    print('')
             url = '%s/%s' % (uniquepath, os.path.basename(self.args.srpm))
         task_id = self.cmd.build(self.args.skip_tag, self.args.scratch,
                                  self.args.background, url, chain, arches,
@@ -887,6 +1072,19 @@ defined, packages will be built sequentially.""" %
         return self._watch_koji_tasks(self.cmd.kojisession,
                                       [task_id])
 
+    def bulk_import(self):
+        if not os.path.isdir(self.args.srpmdir):
+            raise Exception('%s is not a directory' % self.args.srpmdir)
+        srpms = sorted([os.path.join(self.args.srpmdir, file)
+                        for file in os.listdir(self.args.srpmdir)
+                        if file.endswith('.src.rpm')])
+        if not srpms:
+            raise Exception('No srpms found in %s' % self.args.srpmdir)
+        results = self.cmd.import_srpms(srpms, self.args.path,
+                                        jobs=self.args.jobs)
+        if [error for error in results.values() if error]:
+            return 1
+
     def chainbuild(self):
         if self.cmd.module_name in self.args.package:
             raise Exception('%s must not be in the chain' %
@@ -948,12 +1146,51 @@ defined, packages will be built sequentially.""" %
         self.cmd.clog(raw=self.args.raw)
 
     def clone(self):
+        modules = list(self.args.module)
+        if self.args.from_file:
+            try:
+                for line in open(self.args.from_file, 'r').readlines():
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        modules.append(line)
+            except IOError, e:
+                raise Exception('Could not read %s: %s' %
+                                (self.args.from_file, e))
+        if not modules:
+            raise Exception('No module to clone given')
+        # Clone each module once, in the order given
+        seen = set()
+        modules = [module for module in modules
+                   if not (module in seen or seen.add(module))]
         if self.args.branches:
-            self.cmd.clone_with_dirs(self.args.module[0],
-                                     anon=self.args.anonymous)
+            failed = []
+            for module in modules:
+                try:
+                    self.cmd.clone_with_dirs(module,
+                                             anon=self.args.anonymous,
+                                             shared=self.args.shared,
+                                             jobs=self.args.jobs,
+                                             reference=self.args.reference)
+                except Exception, e:
+                    if len(modules) == 1:
+                        raise
+                    self.log.error('Could not clone %s: %s' % (module, e))
+                    failed.append(module)
+            if failed:
+                return 1
+        elif len(modules) == 1:
+            self.cmd.clone(modules[0], branch=self.args.branch,
+                           anon=self.args.anonymous, depth=self.args.depth,
+                           reference=self.args.reference)
         else:
-            self.cmd.clone(self.args.module[0], branch=self.args.branch,
-                           anon=self.args.anonymous)
+            results = self.cmd.clone_modules(modules,
+                                             branch=self.args.branch,
+                                             anon=self.args.anonymous,
+                                             depth=self.args.depth,
+                                             reference=self.args.reference,
+                                             jobs=self.args.jobs)
+            if [module for module in modules if results[module]]:
+                return 1
 
     def commit(self):
         if self.args.clog:
@@ -997,12 +1234,18 @@ defined, packages will be built sequentially.""" %
         self.cmd.diff(self.args.cached, self.args.files)
 
     def gimmespec(self):
+        if self.args.json:
+            self._print_info(['spec'])
+            return
         print(self.cmd.spec)
 
     def gitbuildhash(self):
         print(self.cmd.gitbuildhash(self.args.build))
 
     def giturl(self):
+        if self.args.json:
+            self._print_info(['name', 'commit', 'giturl'])
+            return
         print(self.cmd.giturl())
 
     def import_srpm(self):
@@ -1020,7 +1263,8 @@ defined, packages will be built sequentially.""" %
                          builddir=self.args.builddir)
 
     def lint(self):
-        self.cmd.lint(self.args.info, self.args.rpmlintconf)
+        self.cmd.lint(self.args.info, self.args.rpmlintconf,
+                      jobs=self.args.jobs)
 
     def local(self):
         self.cmd.local(arch=self.args.arch, hashtype=self.args.hash,
@@ -1040,9 +1284,28 @@ defined, packages will be built sequentially.""" %
         except KeyError:
             # there were no args
             pass
+        # Build in each root once, in the order given
+        seen = set()
+        roots = [root for root in self.args.root or []
+                 if not (root in seen or seen.add(root))]
+        if len(roots) > 1:
+            try:
+                results = self.cmd.mockbuild_roots(roots, mockargs,
+                                            hashtype=self.args.hash,
+                                            jobs=self.args.jobs,
+                                            force_srpm=self.args.force_srpm)
+            except Exception, e:
+                self.log.error('Could not run mockbuild: %s' % e)
+                sys.exit(1)
+            if [root for root in roots if results[root][1]]:
+                sys.exit(1)
+            return
+        root = None
+        if roots:
+            root = roots[0]
         try:
-            self.cmd.mockbuild(mockargs, self.args.root,
-                               hashtype=self.args.hash)
+            self.cmd.mockbuild(mockargs, root, hashtype=self.args.hash,
+                               force_srpm=self.args.force_srpm)
         except Exception, e:
             self.log.error('Could not run mockbuild: %s' % e)
             sys.exit(1)
@@ -1055,6 +1318,12 @@ defined, packages will be built sequentially.""" %
             sys.exit(1)
 
     def new(self):
+        if self.args.json:
+            tag = self.cmd.latest_tag()
+            # Patches need not be utf-8, but json has to be
+            diff = self.cmd.new(tag).decode('utf-8', 'replace')
+            self._print_json({'tag': tag, 'diff': diff})
+            return
         print(self.cmd.new())
 
     def new_sources(self):
@@ -1068,7 +1337,8 @@ defined, packages will be built sequentially.""" %
                       "sources file")
 
     def patch(self):
-        self.cmd.patch(self.args.suffix, rediff=self.args.rediff)
+        self.cmd.patch(self.args.suffix, rediff=self.args.rediff,
+                       native=self.args.native)
 
     def prep(self):
         self.cmd.prep(arch=self.args.arch, builddir=self.args.builddir)
@@ -1086,12 +1356,19 @@ defined, packages will be built sequentially.""" %
         self.args.skip_tag = False
         return self.build()
 
+    def server(self):
+        import server
+        server.rpkgServer(self).serve(self.args.socket)
+
     def sources(self):
         self.cmd.sources(self.args.outdir)
 
     def srpm(self):
         self.cmd.sources()
-        self.cmd.srpm(hashtype=self.args.hash)
+        force = False
+        if hasattr(self.args, 'force_srpm'):
+            force = self.args.force_srpm
+        self.cmd.srpm(hashtype=self.args.hash, force=force)
 
     def switch_branch(self):
         if self.args.branch:
@@ -1101,7 +1378,7 @@ defined, packages will be built sequentially.""" %
             # This is some ugly stuff here, but trying to emulate
             # the way git branch looks
             locals = ['  %s  ' % branch for branch in locals]
-            local_branch = self.cmd.repo.active_branch.name
+            local_branch = self.cmd.gitstate['branch']
             locals[locals.index('  %s  ' %
                                 local_branch)] = '* %s' % local_branch
             print('Locals:\n%s\nRemotes:\n  %s' %
@@ -1109,6 +1386,9 @@ defined, packages will be built sequentially.""" %
 
     def tag(self):
         if self.args.list:
+            if self.args.json:
+                self._print_json(self.cmd.list_tags(self.args.tag))
+                return
             self.cmd.list_tag(self.args.tag)
         elif self.args.delete:
             self.cmd.delete_tag(self.args.tag)
@@ -1132,10 +1412,24 @@ defined, packages will be built sequentially.""" %
         self.cmd.verify_files(builddir=self.args.builddir)
 
     def verrel(self):
+        if self.args.json:
+            self._print_info(['name', 'epoch', 'version', 'release', 'nvr'])
+            return
         print('%s-%s-%s' % (self.cmd.module_name, self.cmd.ver,
                             self.cmd.rel))
 
     # Other class stuff goes here
+    def _print_json(self, data):
+        """Write data to stdout as a line of json"""
+
+        json.dump(data, sys.stdout, sort_keys=True)
+        sys.stdout.write('\n')
+
+    def _print_info(self, fields):
+        """Print the module facts asked for with --field, or fields"""
+
+        self._print_json(self.cmd.info(self.args.fields or fields))
+
     # The next 6 functions come from the koji project, from /usr/bin/koji
     # They should be in a library somewhere, but I have to steal them.
     # The code is licensed LGPLv2.1 and thus my (slightly) derived code
@@ -1296,27 +1590,167 @@ Tasks still running. You can continue to watch with the '%s watch-task' command.
         self.log.addHandler(stdouthandler)
         self.log.addHandler(stderrhandler)
 
-    def parse_cmdline(self, manpage=False):
+    def _find_command(self, argv):
+        """Find the name of the command in argv, skipping global options
+
+        Returns None if there is no command, or argv has something we can't
+        make sense of without the full parser.
+        """
+
+        skip = False
+        for arg in argv:
+            if skip:
+                skip = False
+                continue
+            if arg == '--':
+                continue
+            if arg.startswith('-'):
+                if arg.startswith('--') and '=' in arg:
+                    continue
+                action = self.parser._option_string_actions.get(arg)
+                if action is None:
+                    return None
+                # Options like --path take the next argument as value
+                skip = action.nargs != 0
+                continue
+            return arg
+        return None
+
+    def parse_cmdline(self, manpage=False, argv=None):
         """Parse the commandline, optionally make a manpage
 
+        argv defaults to the arguments we were run with.
+
         This also sets up self.user
         """
 
+        if argv is None:
+            argv = sys.argv[1:]
+
         if  manpage:
             # Generate the man page
+            self.subparsers.load_all()
             man_page = __import__('%s' % 
                                   os.path.basename(sys.argv[0]).strip('.py'))
             man_page.generate(self.parser, self.subparsers)
             sys.exit(0)
             # no return possible
 
+        # Only build the parser of the command we are running.  Anything
+        # else, like --help or a typo, needs all of them.
+        command = self._find_command(argv)
+        if not command or command == 'help' or \
+        not self.subparsers.load(command):
+            self.subparsers.load_all()
+
         # Parse the args
-        self.args = self.parser.parse_args()
+        self.args = self.parser.parse_args(argv)
+        # Picking fields only makes sense for json output
+        if getattr(self.args, 'fields', None):
+            self.args.json = True
         if self.args.user:
             self.user = self.args.user
         else:
             self.user = pwd.getpwuid(os.getuid())[0]
 
+class LazySubParsers(object):
+    """Stand in for the argparse subparsers that builds parsers on demand
+
+    Building the parsers of every command takes a good part of our startup
+    time while a run only needs one of them.  add_parser hands out
+    LazyParser objects which record what the register functions do with
+    them, and load builds the parser of a single command.  Anything else
+    asked of this object is passed on to the real subparsers after building
+    all the parsers.
+    """
+
+    def __init__(self, subparsers):
+        self._subparsers = subparsers
+        # Parsers in the order they were registered, and by command name
+        self._parsers = []
+        self._names = {}
+
+    def add_parser(self, name, **kwargs):
+        parser = LazyParser(self._subparsers.add_parser, (name,), kwargs)
+        self._parsers.append(parser)
+        self._names[name] = parser
+        return parser
+
+    def load(self, name):
+        """Build the parser of the named command
+
+        Returns False if there is no such command
+        """
+
+        if name not in self._names:
+            return False
+        self._names[name].build()
+        return True
+
+    def load_all(self):
+        """Build the parsers of all the commands"""
+
+        for parser in self._parsers:
+            parser.build()
+
+    def __getattr__(self, attr):
+        self.load_all()
+        return getattr(self._subparsers, attr)
+
+
+class LazyParser(object):
+    """Records method calls on a parser to replay them when it is built
+
+    Calls return LazyParser objects too, so argument groups and the like
+    work the same way.  Reading a plain attribute builds the parser.
+    """
+
+    def __init__(self, factory=None, args=(), kwargs={}):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._calls = []
+        self._real = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or self._real is not None or \
+        (self._factory and not callable(getattr(argparse.ArgumentParser,
+                                                attr, None))):
+            return getattr(self.build(), attr)
+
+        def record(*args, **kwargs):
+            result = LazyParser()
+            self._calls.append((attr, args, kwargs, result))
+            return result
+        return record
+
+    def _resolve(self, value):
+        """Swap any LazyParser in value, like parents, for the real parser"""
+
+        if isinstance(value, LazyParser):
+            return value.build()
+        if isinstance(value, (list, tuple)):
+            return type(value)([self._resolve(item) for item in value])
+        if isinstance(value, dict):
+            return dict([(key, self._resolve(item))
+                         for key, item in value.items()])
+        return value
+
+    def _replay(self, real):
+        self._real = real
+        for attr, args, kwargs, result in self._calls:
+            result._replay(getattr(real, attr)(*self._resolve(args),
+                                               **self._resolve(kwargs)))
+        self._calls = []
+
+    def build(self):
+        """Build the real parser if needed and return it"""
+
+        if self._real is None:
+            self._replay(self._factory(*self._resolve(self._args),
+                                       **self._resolve(self._kwargs)))
+        return self._real
+
 # Add a class stolen from /usr/bin/koji to watch tasks
 # this was cut/pasted from koji, and then modified for local use.
 # The formatting is koji style, not the stile of this file.  Do not use these
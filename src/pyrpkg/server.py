@@ -0,0 +1,434 @@
+# server.py - run many rpkg commands from a single process
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Scripts that call rpkg over and over pay for starting python, importing
+# koji and friends, reading the config and logging in to the build system
+# every time.  The server keeps all that around and runs the commands that
+# thin clients send it over a unix socket.
+#
+# The protocol is one json object per line.  The client sends a single
+# request of {"argv": [...], "cwd": ..., "config": ...} and gets back any
+# number of {"stream": "stdout" or "stderr", "data": ...} messages followed
+# by {"exit": code}.
+#
+# rpkg batch reads requests of {"id": ..., "command": ..., "path": ...,
+# "args": [...], "options": [...]} from stdin, one per line, and writes a
+# {"id": ..., "exit": ..., "stdout": ..., "stderr": ...} line for each as
+# it finishes.  Requests on different checkouts run in parallel, those on
+# the same checkout in the order given.
+
+import ConfigParser
+import json
+import logging
+import os
+import socket
+import StringIO
+import sys
+import threading
+import traceback
+
+from utils import run_parallel
+
+
+class _StreamProxy(object):
+    """File like object writing to whatever stream the server points it at
+
+    The log handlers and print statements hold on to sys.stdout and
+    sys.stderr, so these stay in place and the server swaps what they
+    write to for each request.  A thread can point its own writes
+    elsewhere by setting local.stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'stream', None) or self.stream
+
+    def write(self, data):
+        self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        # Commands should log their output rather than use our terminal
+        return False
+
+
+class _SocketStream(object):
+    """File like object sending what is written to it to a client"""
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def write(self, data):
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        send(self.conn, {'stream': self.name, 'data': data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def send(conn, message):
+    """Send one message over the connection"""
+
+    conn.sendall(json.dumps(message) + '\n')
+
+
+def forward(path, argv, config=None):
+    """Run a command in the server listening on path
+
+    argv is the command line without the program name, config the config
+    file to use if not the server's own.  Output is written to our stdout
+    and stderr as it arrives.
+
+    Returns the exit code of the command
+    """
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error, e:
+        sys.stderr.write('Could not connect to rpkg server at %s: %s\n' %
+                         (path, e))
+        return 1
+    if config:
+        config = os.path.abspath(config)
+    send(conn, {'argv': argv, 'cwd': os.getcwd(), 'config': config})
+    for line in conn.makefile('r'):
+        message = json.loads(line)
+        if 'exit' in message:
+            conn.close()
+            return message['exit']
+        stream = sys.stdout
+        if message['stream'] == 'stderr':
+            stream = sys.stderr
+        stream.write(message['data'].encode('utf-8'))
+        stream.flush()
+    sys.stderr.write('rpkg server went away\n')
+    return 1
+
+
+class rpkgServer(object):
+    """Run commands for thin clients, keeping Commands objects warm
+
+    client is the cliClient that started the server.  New clients of the
+    same class are made for each request, sharing the Commands objects,
+    and with them the build system sessions and parsed spec data, of
+    earlier requests on the same checkout.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.log = client.log
+        # Parsed config files by path
+        self.configs = {}
+        # Commands objects and the checkout state they were made for, by
+        # the options that went into making them
+        self.cmds = {}
+
+    def _checkout_state(self, path):
+        """Return something that changes when the checkout at path does
+
+        Cached spec and git data can be trusted as long as this stays the
+        same.
+        """
+
+        # HEAD only names the branch, so look at the refs themselves too.
+        # Pushes, fetches and commits all update a file under refs or
+        # packed-refs.
+        refs = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(path, '.git',
+                                                                 'refs')):
+            dirnames.sort()
+            refs.extend([os.path.relpath(os.path.join(dirpath, name), path)
+                         for name in sorted(filenames)])
+        state = []
+        for name in ['.', '.git/HEAD', '.git/index', '.git/packed-refs',
+                     '.git/FETCH_HEAD', 'sources'] + refs + \
+        [f for f in os.listdir(path) if f.endswith('.spec')]:
+            try:
+                info = os.stat(os.path.join(path, name))
+                state.append((name, info.st_mtime, info.st_size))
+            except OSError:
+                state.append((name, None, None))
+        return state
+
+    def _config(self, path):
+        """Return the parsed config file at path"""
+
+        if not path:
+            return self.client.config
+        if path not in self.configs:
+            if not os.path.exists(path):
+                raise Exception('Invalid config file %s' % path)
+            config = ConfigParser.SafeConfigParser()
+            config.read(path)
+            self.configs[path] = config
+        return self.configs[path]
+
+    def _load_cmd(self, client, config_path):
+        """Give client a Commands object, reusing a cached one if we can"""
+
+        path = os.path.abspath(client.args.path)
+        target = getattr(client.args, 'target', None)
+        key = (config_path, path, client.args.user, client.args.dist, target)
+        state = self._checkout_state(path)
+        cmd = None
+        if key in self.cmds:
+            cmd, oldstate = self.cmds[key]
+            if oldstate != state:
+                # Start over for the checkout, but keep the sessions
+                self.log.debug('%s changed, reloading it' % path)
+                old = cmd
+                client.load_cmd()
+                cmd = client._cmd
+                cmd._anon_kojisession = old._anon_kojisession
+                cmd._kojisession = old._kojisession
+                cmd._kojiweburl = old._kojiweburl
+                cmd._topurl = old._topurl
+        if cmd is None:
+            client.load_cmd()
+            cmd = client._cmd
+        # Builds log out when they are done with the session
+        if cmd._kojisession is not None and \
+        not getattr(cmd._kojisession, 'logged_in', False):
+            cmd._kojisession = None
+        cmd.quiet = client.args.q
+        # Edits to tracked files change nothing the checkout state looks at,
+        # so ask git about the tree again for every request
+        cmd._forget_gitstate()
+        client._cmd = cmd
+        self.cmds[key] = (cmd, state)
+
+    def _client(self, argv, config_path=None):
+        """Return a new client with argv parsed"""
+
+        client = self.client.__class__(self._config(config_path),
+                                       name=self.client.name)
+        client.site = self.client.site
+        client.log = self.log
+        client.parse_cmdline(argv=argv)
+        if client.args.command in (client.server, client.batch):
+            raise Exception('Cannot run this command here')
+        return client
+
+    def _exit_code(self, request, stderr):
+        """Run request and return its exit code, the way the rpkg script
+        would have exited
+        """
+
+        try:
+            try:
+                rv = self.run(request)
+            except SystemExit, e:
+                rv = e.code
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.log.debug(traceback.format_exc())
+                self.log.error('Could not execute %s: %s' %
+                               (request.get('command') or
+                                ' '.join(request['argv']), e))
+                rv = 1
+        finally:
+            sys.stdout.local.stream = None
+            sys.stderr.local.stream = None
+        if rv is None:
+            rv = 0
+        elif not isinstance(rv, int):
+            stderr.write('%s\n' % rv)
+            rv = 1
+        return rv
+
+    def _redirect_output(self):
+        """Put the stdout and stderr proxies in place"""
+
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        sys.stdout = _StreamProxy(self.stdout)
+        sys.stderr = _StreamProxy(self.stderr)
+        sys.stdin = open(os.devnull, 'r')
+        for handler in self.log.handlers:
+            if isinstance(handler, logging.StreamHandler):
+                if handler.stream is self.stdout:
+                    handler.stream = sys.stdout
+                elif handler.stream is self.stderr:
+                    handler.stream = sys.stderr
+
+    def run(self, request):
+        """Run the command from request, returns the exit code"""
+
+        os.chdir(request['cwd'])
+        config_path = request.get('config')
+        client = self._client(request['argv'], config_path)
+        if not client.args.path:
+            client.args.path = request['cwd']
+        if client.args.v:
+            self.log.setLevel(logging.DEBUG)
+        elif client.args.q:
+            self.log.setLevel(logging.WARNING)
+        else:
+            self.log.setLevel(logging.INFO)
+        self._load_cmd(client, config_path)
+        return client.args.command()
+
+    def handle(self, conn):
+        """Read a request from conn and answer it"""
+
+        line = conn.makefile('r').readline()
+        if not line:
+            return
+        request = json.loads(line)
+        stdout = _SocketStream(conn, 'stdout')
+        stderr = _SocketStream(conn, 'stderr')
+        sys.stdout.stream = stdout
+        sys.stderr.stream = stderr
+        cwd = os.getcwd()
+        try:
+            rv = self._exit_code(request, stderr)
+        finally:
+            sys.stdout.stream = self.stdout
+            sys.stderr.stream = self.stderr
+            os.chdir(cwd)
+        send(conn, {'exit': rv})
+
+    def serve(self, path):
+        """Listen on the unix socket at path and run requests one by one
+
+        Requests are handled in turn, as commands change directory and
+        share the process wide stdout and stderr.
+        """
+
+        # Keep the log handlers and prints pointed at the current request
+        self._redirect_output()
+
+        if os.path.exists(path):
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only our user gets to run commands as us
+        oldmask = os.umask(0077)
+        try:
+            listener.bind(path)
+        finally:
+            os.umask(oldmask)
+        listener.listen(16)
+        self.stdout.write('Listening on %s\n' % path)
+        try:
+            while True:
+                conn = listener.accept()[0]
+                try:
+                    self.handle(conn)
+                except (socket.error, ValueError), e:
+                    self.stderr.write('Dropped request: %s\n' % e)
+                conn.close()
+        finally:
+            listener.close()
+            os.remove(path)
+
+
+class rpkgBatch(rpkgServer):
+    """Run json-lines requests, keeping Commands objects warm
+
+    Requests on the same checkout share a Commands object, and with it the
+    build system session and parsed spec data, and run one after the other.
+    Different checkouts are worked on by up to jobs threads at once.
+
+    The log level is the one batch was run with, options like -v in a
+    request do not change it.
+    """
+
+    def __init__(self, client, jobs=None):
+        super(rpkgBatch, self).__init__(client)
+        self.jobs = jobs
+        self.lock = threading.Lock()
+
+    def run(self, request):
+        """Run the command from request, returns the exit code"""
+
+        if not request.get('command') or not request.get('path'):
+            raise Exception('Requests need a command and a path')
+        path = os.path.abspath(os.path.expanduser(request['path']))
+        argv = list(request.get('options', [])) + ['--path', path,
+                                                   request['command']] + \
+               list(request.get('args', []))
+        client = self._client(argv)
+        self._load_cmd(client, None)
+        return client.args.command()
+
+    def _answer(self, request):
+        """Run request and write out its result"""
+
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        sys.stdout.local.stream = stdout
+        sys.stderr.local.stream = stderr
+        rv = self._exit_code(request, stderr)
+        result = {'id': request.get('id'), 'exit': rv,
+                  'stdout': stdout.getvalue().decode('utf-8', 'replace'),
+                  'stderr': stderr.getvalue().decode('utf-8', 'replace')}
+        self.lock.acquire()
+        try:
+            self.stdout.write(json.dumps(result) + '\n')
+            self.stdout.flush()
+        finally:
+            self.lock.release()
+        return rv
+
+    def process(self, infile):
+        """Run the requests read from infile, writing results to stdout
+
+        Returns the number of requests that failed
+        """
+
+        # Requests in the order given for each checkout
+        groups = {}
+        order = []
+        failed = 0
+        self._redirect_output()
+        for lineno, line in enumerate(infile):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                request.setdefault('id', lineno + 1)
+                key = os.path.abspath(os.path.expanduser(request['path']))
+            except (ValueError, KeyError, AttributeError, TypeError), e:
+                self.stdout.write(json.dumps({'id': lineno + 1, 'exit': 1,
+                                              'stdout': '',
+                                              'stderr': 'Bad request: %s\n'
+                                              % e}) + '\n')
+                failed += 1
+                continue
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(request)
+
+        def run_group(key):
+            return len([r for r in groups[key] if self._answer(r)])
+
+        for key, count, error in run_parallel(run_group, order, self.jobs,
+                                              self.log):
+            if error:
+                self.stderr.write('Requests on %s failed: %s\n' % (key,
+                                                                     error))
+                count = len(groups[key])
+            failed += count
+        return failed
@@ -0,0 +1,159 @@
+# utils.py - small helpers shared by the pyrpkg modules
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+import os
+import Queue
+import sys
+import tempfile
+import threading
+
+# The umask, read once while nothing else can be creating files
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+class LazyModule(object):
+    """Stand in for a module that only gets imported when first used
+
+    Modules like koji, rpm and git are slow to import and most commands
+    only need some of them, so we bind a LazyModule to the name instead
+    and let the first attribute lookup do the real import.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
+
+
+def run_parallel(func, items, jobs=None, log=None):
+    """Call func on each of items using up to jobs worker threads
+
+    func is called with a single item and may raise, jobs defaults to one
+    thread per item.  Failures are logged at debug level to log if given.
+
+    Returns a list of (item, result, error) tuples in the order of items,
+    where error is the exception func raised for that item, or None.
+    """
+
+    items = list(items)
+    if not items:
+        return []
+    if not jobs or jobs > len(items):
+        jobs = len(items)
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (item, func(item), None)
+            except Exception, e:
+                if log:
+                    log.debug('Job %s failed: %s' % (item, e))
+                results[index] = (item, None, e)
+
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so a ^C still reaches the main thread
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
+
+class AtomicFile(object):
+    """File object that replaces path in one go when closed
+
+    What is written goes to a temporary file next to path, which close
+    renames over path, so readers and later runs see either the old file
+    or the new one, never part of either.  abort throws the new content
+    away instead.
+
+    With fsync the data, and then the rename, are flushed to disk before
+    close returns, so they survive a crash as well.  Caches and other
+    files that are cheap to recreate can skip that.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = os.path.abspath(path)
+        self.fsync = fsync
+        # Keep the mode of the file we replace, or make it like open would
+        if os.path.exists(self.path):
+            self.mode = os.stat(self.path).st_mode & 07777
+        else:
+            self.mode = 0666 & ~_umask
+        fd, self.tmppath = tempfile.mkstemp(prefix='.%s.' %
+                                            os.path.basename(self.path),
+                                            dir=os.path.dirname(self.path))
+        self.file = os.fdopen(fd, 'w')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def writelines(self, lines):
+        self.file.writelines(lines)
+
+    def close(self):
+        """Put the new file in place"""
+
+        if self.file.closed:
+            return
+        try:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            os.chmod(self.tmppath, self.mode)
+            os.rename(self.tmppath, self.path)
+        except:
+            self.abort()
+            raise
+        if self.fsync:
+            dirfd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+    def abort(self):
+        """Throw the new file away, leaving path as it was"""
+
+        self.file.close()
+        if os.path.exists(self.tmppath):
+            os.remove(self.tmppath)
+
+
+def write_atomic(path, data, fsync=True):
+    """Replace the file at path with data in one go, see AtomicFile"""
+
+    output = AtomicFile(path, fsync)
+    try:
+        output.write(data)
+    except:
+        output.abort()
+        raise
+    output.close()
@@ -33,9 +33,9 @@ _rpkg()
     # global options
 
     local options="--help -v -q"
-    local options_value="--dist --user --path"
-    local commands="build chain-build ci clean clog clone co commit compile diff gimmespec giturl help \
-    gitbuildhash import install lint local mockbuild mock-config new new-sources patch prep pull push scratch-build sources \
+    local options_value="--dist --user --path --connect"
+    local commands="batch build bulk-import chain-build ci clean clog clone co commit compile diff gimmespec giturl help \
+    gitbuildhash import install lint local mockbuild mock-config new new-sources patch prep pull push scratch-build server sources \
     srpm switch-branch tag unused-patches upload verify-files verrel"
 
     # parse main options and get command
@@ -95,13 +95,28 @@ _rpkg()
     local after= after_more=
 
     case $command in
-        help|gimmespec|gitbuildhash|giturl|lint|new|push|unused-patches|verrel)
+        help|gitbuildhash|lint|push|unused-patches)
+            ;;
+        gimmespec|giturl|verrel)
+            options="--json"
+            options_string="--field"
+            ;;
+        new)
+            options="--json"
+            ;;
+        batch)
+            options_string="--jobs -j"
             ;;
         build)
-            options="--nowait --background --skip-tag --scratch --md5"
+            options="--nowait --background --skip-tag --scratch --md5 --force-srpm"
             options_arches="--arches"
             options_srpm="--srpm"
             options_target="--target"
+            options_string="--upload-jobs"
+            ;;
+        bulk-import)
+            options_string="--jobs -j"
+            after="dir"
             ;;
         chain-build)
             options="--nowait --background"
@@ -116,9 +131,13 @@ _rpkg()
             options="--raw"
             ;;
         clone|co)
-            options="--branches --anonymous"
+            options="--branches --anonymous --shared"
             options_branch="-b"
+            options_string="--jobs -j --depth"
+            options_file="--from-file -f"
+            options_dir="--reference"
             after="package"
+            after_more=true
             ;;
         commit|ci)
             options="--push --clog --raw --tag"
@@ -145,6 +164,7 @@ _rpkg()
         lint)
             options="--info"
             options_file="--rpmlintconf"
+            options_string="--jobs -j"
             ;;
         local)
             options="--md5"
@@ -156,11 +176,12 @@ _rpkg()
             options_arch="--arch"
             ;;
         mockbuild)
-            options="--md5"
+            options="--md5 --force-srpm"
             options_mroot="--root"
+            options_string="--jobs -j"
             ;;
         patch)
-            options="--rediff"
+            options="--rediff --native"
             options_string="--suffix"
             ;;
         prep|verify-files)
@@ -171,23 +192,27 @@ _rpkg()
             options="--rebase --no-rebase"
             ;;
         scratch-build)
-            options="--nowait --background --md5"
+            options="--nowait --background --md5 --force-srpm"
             options_target="--target"
             options_arches="--arches"
             options_srpm="--srpm"
+            options_string="--upload-jobs"
+            ;;
+        server)
+            options_file="--socket"
             ;;
         sources)
             options_dir="--outdir"
             ;;
         srpm)
-            options="--md5"
+            options="--md5 --force"
             ;;
         switch-branch)
             options="--list"
             after="branch"
             ;;
         tag)
-            options="--clog --raw --force --list --delete"
+            options="--clog --raw --force --list --delete --json"
             options_string="--message"
             options_file="--file"
             after_more=true
@@ -250,6 +275,7 @@ _rpkg()
         if [[ $after_counter -eq 0 ]] || [[ $after_more = true ]]; then
             case $after in
                 file)    _filedir_exclude_paths ;;
+                dir)     _filedir_exclude_paths -d ;;
                 srpm)    _filedir_exclude_paths "*.src.rpm" ;;
                 branch)  after_options="$(_rpkg_branch "$path")" ;;
                 package) after_options="$(_rpkg_package "$cur")";;
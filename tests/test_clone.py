@@ -0,0 +1,93 @@
+# test_clone.py - clone several modules from the command line
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python -m unittest discover tests
+
+import ConfigParser
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import pyrpkg
+import pyrpkg.cli
+
+
+class CloneCommands(pyrpkg.Commands):
+    """Commands that record the clones asked for instead of cloning"""
+
+    def __init__(self):
+        self.log = logging.getLogger('rpkg-test')
+        self.cloned = []
+
+    def clone(self, module, path=None, branch=None, bare_dir=None,
+              anon=False, depth=None, reference=None):
+        self.cloned.append((module, bare_dir, reference))
+
+    def clone_with_dirs(self, module, anon=False, shared=False, jobs=None,
+                        reference=None):
+        self.cloned.append((module, 'dirs', reference))
+
+
+class CloneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        config = ConfigParser.SafeConfigParser()
+        section = os.path.basename(sys.argv[0])
+        config.add_section(section)
+        for option in ('lookaside', 'lookasidehash', 'lookaside_cgi',
+                       'gitbaseurl', 'anongiturl', 'branchre', 'kojiconfig',
+                       'build_client'):
+            config.set(section, option, 'x')
+        self.client = pyrpkg.cli.cliClient(config, name='rpkg')
+        self.client.log = logging.getLogger('rpkg-test')
+        self.client._cmd = CloneCommands()
+
+    def clone(self, argv):
+        self.client.parse_cmdline(argv=['clone'] + argv)
+        self.client.clone()
+        return self.client._cmd.cloned
+
+    def test_branches_reject_depth(self):
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            self.assertRaises(SystemExit, self.client.parse_cmdline,
+                              argv=['clone', '--branches', '--depth', '1',
+                                    'foo'])
+        finally:
+            sys.stderr = stderr
+
+    def test_branches_pass_reference(self):
+        self.assertEqual(self.clone(['--branches', '--reference', '/ref',
+                                     'foo']),
+                         [('foo', 'dirs', '/ref')])
+
+    def test_duplicate_modules_clone_once(self):
+        self.assertEqual(self.clone(['foo', 'foo']),
+                         [('foo', None, None)])
+        modules = []
+
+        def run_parallel(func, items, jobs):
+            modules.extend(items)
+            return [(item, None, None) for item in items]
+        self.client._cmd._run_parallel = run_parallel
+        self.client._cmd.clone_modules(['bar', 'foo', 'bar', 'baz', 'foo'],
+                                       path='/tmp', anon=True)
+        self.assertEqual(modules, ['bar', 'foo', 'baz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# test_mockbuild.py - build in several mock roots at once
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python -m unittest discover tests
+
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import pyrpkg
+
+
+class MockCommands(pyrpkg.Commands):
+    """Commands that record the mock roots built in instead of building"""
+
+    def __init__(self):
+        self.log = logging.getLogger('rpkg-test')
+        self._mockconfig = 'default'
+        self.built = []
+        self.lock = threading.Lock()
+
+    def srpm(self, hashtype=None, force=False):
+        pass
+
+    def _mockbuild_root(self, root, mockargs, genconfig=False):
+        with self.lock:
+            self.built.append(root)
+        return '/results/%s' % root
+
+
+class MockbuildRootsTestCase(unittest.TestCase):
+
+    def test_duplicate_roots_build_once(self):
+        cmd = MockCommands()
+        results = cmd.mockbuild_roots(['a', 'b', 'a', 'default'], jobs=4)
+        self.assertEqual(sorted(cmd.built), ['a', 'b', 'default'])
+        self.assertEqual(results, {'a': ('/results/a', None),
+                                   'b': ('/results/b', None),
+                                   'default': ('/results/default', None)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# test_server.py - run requests through the server and batch modes
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python -m unittest discover tests
+
+import ConfigParser
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import pyrpkg
+import pyrpkg.cli
+from pyrpkg.server import rpkgServer, rpkgBatch
+
+
+class GitRunner(object):
+    """Stands in for GitPython's repo.git, running git in path"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __getattr__(self, name):
+        def run(*args):
+            return subprocess.check_output(['git', name.replace('_', '-')] +
+                                           list(args),
+                                           cwd=self.path).rstrip('\n')
+        return run
+
+
+class FakeRepo(object):
+
+    def __init__(self, path):
+        self.git = GitRunner(path)
+
+
+def git(path, *args):
+    env = dict(os.environ)
+    for var in ['GIT_AUTHOR', 'GIT_COMMITTER']:
+        env.setdefault(var + '_NAME', 'test')
+        env.setdefault(var + '_EMAIL', 'test@example.com')
+    subprocess.check_call(['git'] + list(args), cwd=path, env=env,
+                          stdout=open(os.devnull, 'w'))
+
+
+class RecordingCommands(pyrpkg.Commands):
+    """Commands that record what they would run instead of running it"""
+
+    # The commands run by any of these objects, in order
+    ran = []
+
+    def load_repo(self):
+        self._repo = FakeRepo(self.path)
+
+    def load_rpmdefines(self):
+        self._rpmdefines = ["--define '_sourcedir %s'" % self.path]
+
+    def sources(self, outdir=None):
+        pass
+
+    def _run_command(self, cmd, shell=False, env=None, pipe=[], cwd=None):
+        self.ran.append(cmd)
+
+
+class site(object):
+    Commands = RecordingCommands
+
+
+class ServerTestCase(unittest.TestCase):
+
+    server_class = rpkgServer
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='rpkg-test-')
+        open(os.path.join(self.path, 'foo.spec'), 'w').write('Name: foo\n')
+        config = ConfigParser.SafeConfigParser()
+        section = os.path.basename(sys.argv[0])
+        config.add_section(section)
+        for option in ('lookaside', 'lookasidehash', 'lookaside_cgi',
+                       'gitbaseurl', 'anongiturl', 'branchre', 'kojiconfig',
+                       'build_client'):
+            config.set(section, option, 'x')
+        client = pyrpkg.cli.cliClient(config, name='rpkg')
+        client.site = site
+        client.log = logging.getLogger('rpkg-test')
+        self.server = self.server_class(client)
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def run_command(self, argv):
+        """Run argv through the server, returns the Commands it used"""
+
+        self.server.run({'argv': argv, 'cwd': self.path, 'config': None})
+        return self.server.cmds.values()[0][0]
+
+    def test_builddir_does_not_leak(self):
+        del RecordingCommands.ran[:]
+        first = self.run_command(['prep', '--builddir', '/tmp/elsewhere'])
+        second = self.run_command(['prep'])
+        self.assertTrue(first is second)
+        self.assertEqual(len(RecordingCommands.ran), 2)
+        builddir = "--define '_builddir /tmp/elsewhere'"
+        self.assertTrue(builddir in ' '.join(RecordingCommands.ran[0]))
+        self.assertFalse(builddir in ' '.join(RecordingCommands.ran[1]))
+        self.assertEqual(second.rpmdefines,
+                         ["--define '_sourcedir %s'" % self.path])
+
+    def test_edits_make_the_tree_dirty(self):
+        git(self.path, 'init', '-q')
+        open(os.path.join(self.path, 'fix.patch'), 'w').write('old\n')
+        git(self.path, 'add', 'foo.spec', 'fix.patch')
+        git(self.path, 'commit', '-q', '-m', 'import')
+        # Some branch config, as git config fails when it finds none
+        git(self.path, 'config', 'branch.other.remote', 'origin')
+        # Make the index up to date and not racy, so git status has no
+        # reason to rewrite it
+        for name in ('foo.spec', 'fix.patch'):
+            os.utime(os.path.join(self.path, name), (1, 1))
+        git(self.path, 'update-index', '-q', '--really-refresh')
+        first = self.run_command(['prep'])
+        self.assertFalse(first.gitstate['dirty'])
+        # Only the contents of a tracked patch change
+        open(os.path.join(self.path, 'fix.patch'), 'a').write('new\n')
+        second = self.run_command(['prep'])
+        self.assertTrue(first is second)
+        self.assertTrue(second.gitstate['dirty'])
+
+
+class BatchTestCase(ServerTestCase):
+
+    server_class = rpkgBatch
+
+    def run_command(self, argv):
+        """Run argv as a batch request, returns the Commands it used"""
+
+        self.server.run({'command': argv[0], 'args': argv[1:],
+                         'path': self.path})
+        return self.server.cmds.values()[0][0]
+
+    def test_builddir_does_not_leak_between_commands(self):
+        del RecordingCommands.ran[:]
+        self.run_command(['compile', '--builddir', '/tmp/elsewhere'])
+        self.run_command(['prep'])
+        self.assertEqual(len(RecordingCommands.ran), 2)
+        self.assertFalse('_builddir' in ' '.join(RecordingCommands.ran[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
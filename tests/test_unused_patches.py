@@ -0,0 +1,145 @@
+# test_unused_patches.py - find the patches a spec does not use
+#
+# Copyright (C) 2011 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Run from the top of the source tree:
+#
+#   python -m unittest discover tests
+
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import pyrpkg
+
+SPEC = """\
+Name: foo
+Version: 1.0
+Release: 1
+Summary: Test package
+License: GPLv2+
+Source0: foo-1.0.tar.gz
+Patch0: foo-1.0-fix.patch
+%ifarch s390x
+Patch1: foo-1.0-s390x.patch
+%endif
+%if 0%{?rhel}
+Patch2: %{name}-rhel.patch
+%endif
+
+%description
+Test package
+
+%prep
+%setup -q
+%patch0 -p1
+%ifarch s390x
+%patch1 -p1
+%endif
+%if 0%{?rhel}
+%patch2 -p1
+%endif
+"""
+
+
+class FakeRpm(object):
+    """Parses specs the way rpm would on x86_64 without rhel defined
+
+    Patches under %ifarch s390x or %if 0%{?rhel} are left out.
+    """
+
+    RPMBUILD_ISPATCH = 2
+
+    def addMacro(self, name, value):
+        pass
+
+    def delMacro(self, name):
+        pass
+
+    def spec(self, path):
+        sources = []
+        skipping = 0
+        for line in open(path):
+            if line.startswith(('%ifarch s390x', '%if 0%{?rhel}')):
+                skipping += 1
+            elif line.startswith('%endif'):
+                skipping = max(skipping - 1, 0)
+            elif not skipping:
+                match = re.match(r'(Source|Patch)(\d+): (.*)', line)
+                if match:
+                    name = match.group(3).replace('%{name}', 'foo')
+                    flags = match.group(1) == 'Patch' and 2 or 1
+                    sources.append((name, int(match.group(2)), flags))
+
+        class header(object):
+            pass
+        hdr = header()
+        hdr.sources = sources
+        return hdr
+
+
+class FakeGit(object):
+
+    def __init__(self, files):
+        self.files = files
+
+    def ls_files(self, *args):
+        return '\n'.join(self.files)
+
+
+class FakeRepo(object):
+
+    def __init__(self, files):
+        self.git = FakeGit(files)
+
+
+class SpecCommands(pyrpkg.Commands):
+
+    def __init__(self, path, files):
+        self.path = path
+        self.lookasidehash = 'md5'
+        self.log = logging.getLogger('rpkg-test')
+        self._repo = FakeRepo(files)
+        self._spec = 'foo.spec'
+        self._module_name = 'foo'
+        self._ver = '1.0'
+        self._rpmdefines = None
+
+    def load_rpmdefines(self):
+        self._rpmdefines = []
+
+
+class UnusedPatchesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='rpkg-test-')
+        open(os.path.join(self.path, 'foo.spec'), 'w').write(SPEC)
+        self.rpm = pyrpkg.rpm
+        pyrpkg.rpm = FakeRpm()
+
+    def tearDown(self):
+        pyrpkg.rpm = self.rpm
+        shutil.rmtree(self.path)
+
+    def test_conditional_patches_are_used(self):
+        cmd = SpecCommands(self.path, ['foo.spec', 'foo-1.0-fix.patch',
+                                       'foo-1.0-s390x.patch',
+                                       'foo-rhel.patch', 'old.patch'])
+        self.assertEqual(cmd.unused_patches(), ['old.patch'])
+
+
+if __name__ == '__main__':
+    unittest.main()